@@ -1,13 +1,44 @@
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from decimal import Decimal
+
 import click
 
-from src.models import create_db_models
-from src.fetch_data import fetch_all_data
-from src.stats import BuildAccountDelegation, VoteStatBuilder, GenerateDistribution
+from src.config import FETCH_CONCURRENCY, GRAPH_QUERY_URL, INSERT_BATCH_SIZE, SNAPSHOT_DIR, SNAPSHOT_PARTITION_BLOCKS
+from src.models import VoteCast, create_db_indexes, create_db_models
+from src.benchmark import run_benchmark
+from src.database import engine
+from src.export import EXPORT_FORMATS
+from src.fetch_data import STREAMS, SYNC_STATE_KEYS, TRANSFER_MODES, fetch_all_data, list_sync_state, reset_sync_state
+from src.instrumentation import profiler
+from src.replay import FixtureRecorder, StandInIndexer, load_fixtures, synthetic_fixtures
+from src.snapshot import read_snapshot_table, use_snapshot, write_snapshot
+from src.stats import VOTE_CAST_COLUMNS, BuildAccountDelegation, VoteStatBuilder, GenerateDistribution
+from src.utils import WEI_PER_ETHER
 
 @click.group()
-def main():
+@click.option("--echo-sql", is_flag=True, help="Log every SQL statement, same as SQL_ECHO=true.")
+@click.option("--profile-sql", is_flag=True, help="Print query counts and database time per stage and call site.")
+@click.option("--sql-report", default=None, help="Write the query profile as JSON to this file.")
+@click.pass_context
+def main(ctx, echo_sql, profile_sql, sql_report):
     """This is the main command."""
-    pass
+    if echo_sql:
+        engine.echo = True
+    if profile_sql or sql_report:
+        profiler.enable()
+        ctx.call_on_close(lambda: report_query_profile(profile_sql, sql_report))
+
+
+def report_query_profile(profile_sql, sql_report):
+    if profile_sql:
+        click.echo(profiler.format_report())
+    if sql_report:
+        with open(sql_report, "w") as f:
+            json.dump(profiler.report(), f, indent=2)
 
 
 @main.command()
@@ -17,23 +48,191 @@ def create_models():
 
 
 @main.command()
-def fetch_and_store_data():
+def create_indexes():
+    created_indexes = create_db_indexes()
+    for index_name in created_indexes:
+        click.echo(f"Created index {index_name}")
+    click.echo("Indexes up to date")
+
+
+@main.command()
+@click.option("--bulk/--row-by-row", default=True, help="Write each fetched page as one batch.")
+@click.option("--batch-size", default=INSERT_BATCH_SIZE, show_default=True, help="Rows per INSERT in bulk mode.")
+@click.option("--concurrency", default=FETCH_CONCURRENCY, show_default=True, help="Number of streams fetched in parallel.")
+@click.option("--shards", default=1, show_default=True, help="Number of block range shards for the sharded streams.")
+@click.option("--shard-stream", "sharded_streams", multiple=True, type=click.Choice(list(STREAMS)),
+              help="Entity stream fetched in block range shards when --shards > 1. "
+                   "Defaults to transfers with --transfers full, delegateVotesChangeds otherwise.")
+@click.option("--composite-cursor/--block-cursor", default=True,
+              help="Page on (blockNumber, id) so every entity is fetched once, or on blockNumber_gte only.")
+@click.option("--url", default=None, help="Subgraph endpoint, defaults to GRAPH_QUERY_URL.")
+@click.option("--transfers", default="targeted", show_default=True, type=click.Choice(TRANSFER_MODES),
+              help="Fetch only the transfers of delegation transactions, or the full transfers stream.")
+@click.option("--batch-queries", is_flag=True,
+              help="Fetch the next page of every stream and shard in one request, using GraphQL aliases.")
+@click.option("--writers", default=1, show_default=True,
+              help="Threads per stream writing fetched pages while the next ones are fetched, 0 to alternate.")
+def fetch_and_store_data(
+        bulk, batch_size, concurrency, shards, sharded_streams, composite_cursor, url, transfers, batch_queries, writers
+):
     click.echo("Fetching and storing data...")
-    fetch_all_data()
-    click.echo("Fetched all data")
+    rows_fetched = Counter()
+    pages_fetched = Counter()
+    start_time = time.monotonic()
+
+    def report_progress(table_key, page_rows):
+        rows_fetched[table_key] += page_rows
+        pages_fetched[table_key] += 1
+        click.echo(f"{table_key}: {rows_fetched[table_key]} rows fetched")
+
+    with profiler.stage("fetch"):
+        fetch_all_data(
+            bulk=bulk,
+            batch_size=batch_size,
+            concurrency=concurrency,
+            progress=report_progress,
+            shards=shards,
+            sharded_streams=sharded_streams or None,
+            composite_cursor=composite_cursor,
+            url=url,
+            transfers=transfers,
+            batch_queries=batch_queries,
+            writers=writers,
+        )
+    elapsed = time.monotonic() - start_time
+    rows, pages = sum(rows_fetched.values()), sum(pages_fetched.values())
+    click.echo(
+        f"Fetched all data: {rows} rows in {pages} pages in {elapsed:.1f}s "
+        f"({rows / elapsed:.0f} rows/s, {pages / elapsed:.1f} pages/s)"
+    )
+
+
+@main.command()
+@click.option("--reset", "reset_streams", multiple=True, type=click.Choice(SYNC_STATE_KEYS),
+              help="Forget the cursor of this stream, the next fetch recomputes it from the stored rows.")
+def sync_state(reset_streams):
+    """Shows the cursor every entity stream resumes from."""
+    if reset_streams:
+        reset_sync_state(reset_streams)
+        click.echo(f"Reset {', '.join(reset_streams)}")
+    for state in list_sync_state():
+        click.echo(
+            f"{state.stream}: block {state.blockNumber}, id {state.entity_id}, synced to block {state.synced_block}, "
+            f"updated {state.updated_at:%Y-%m-%d %H:%M:%S}"
+        )
+
+
+@main.command()
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8000, show_default=True)
+@click.option("--fixtures", "fixtures_directory", default="fixtures", show_default=True,
+              help="Directory of the recorded <table_key>.jsonl.gz fixtures.")
+@click.option("--record", is_flag=True, help="Forward queries to --upstream and record the responses to --fixtures.")
+@click.option("--upstream", default=GRAPH_QUERY_URL, help="Subgraph endpoint used with --record.")
+@click.option("--synthetic", "synthetic_rows", default=0, help="Serve this many random entities per stream instead.")
+@click.option("--seed", default=1, show_default=True, help="Seed of the synthetic entities.")
+@click.option("--max-complexity", default=None, type=int,
+              help="Reject queries requesting more than this many entities times fields, like a hosted indexer.")
+def serve_indexer(host, port, fixtures_directory, record, upstream, synthetic_rows, seed, max_complexity):
+    """Local stand-in for the subgraph endpoint, point fetch-and-store-data --url at it."""
+    if record:
+        server = StandInIndexer((host, port), upstream_url=upstream, recorder=FixtureRecorder(fixtures_directory))
+        click.echo(f"Recording {upstream} to {fixtures_directory}")
+    else:
+        if synthetic_rows:
+            fixtures = synthetic_fixtures(synthetic_rows, seed=seed)
+        else:
+            fixtures = load_fixtures(fixtures_directory)
+        server = StandInIndexer((host, port), fixtures=fixtures, max_complexity=max_complexity)
+        for table_key, entities in fixtures.items():
+            click.echo(f"{table_key}: {len(entities)} entities")
+    click.echo(f"Serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+@main.command()
+@click.option("--directory", default=SNAPSHOT_DIR, show_default=True, help="Directory of the snapshot.")
+@click.option("--partition-blocks", default=SNAPSHOT_PARTITION_BLOCKS, show_default=True,
+              help="Number of blocks per parquet partition.")
+@click.option("--full", is_flag=True, help="Rewrite every partition instead of only the new ones.")
+def snapshot_data(directory, partition_blocks, full):
+    click.echo("Writing snapshot...")
+    with profiler.stage("snapshot"):
+        written = write_snapshot(directory, partition_blocks=partition_blocks, full=full)
+    for table_name, path, rows in written:
+        click.echo(f"{table_name}: {rows} rows written to {path}")
+    click.echo("Snapshot written")
+
+
+@main.command()
+@click.option("--rebuild", is_flag=True, help="Recompute all delegation records instead of only new transactions.")
+@click.option("--streaming", is_flag=True, help="Export in chunks with constant memory.")
+@click.option("--export-format", "export_formats", multiple=True, default=["xlsx"], show_default=True,
+              type=click.Choice(EXPORT_FORMATS), help="Output format of the streaming export.")
+@click.option("--snapshot", "snapshot_directory", default=None,
+              help="Generate from the parquet snapshot in this directory instead of the database.")
+@click.option("--workers", default=1, show_default=True,
+              help="Number of processes classifying transactions and building the vote stats.")
+def generate_distribution(rebuild, streaming, export_formats, snapshot_directory, workers):
+    # holds the database loaded from the snapshot for the duration of the run
+    with tempfile.TemporaryDirectory() as database_directory:
+        vote_casts = None
+        if snapshot_directory:
+            click.echo("Loading snapshot...")
+            with profiler.stage("load snapshot"):
+                use_snapshot(os.path.join(database_directory, "snapshot.db"), snapshot_directory)
+                vote_casts = read_snapshot_table(VoteCast, snapshot_directory, columns=VOTE_CAST_COLUMNS)
+        click.echo("Building delegation records...")
+        with profiler.stage("delegation records"):
+            BuildAccountDelegation().build(rebuild=rebuild, workers=workers)
+        click.echo("delegation records built")
+        click.echo("Building vote stats...")
+        with profiler.stage("vote stats"):
+            VoteStatBuilder(vote_casts).build(workers=workers)
+        click.echo("Built vote stats")
+        click.echo("Generating distribution...")
+        with profiler.stage("distribution"):
+            distribution = GenerateDistribution(vote_casts)
+            distribution.generate(streaming=streaming, export_formats=export_formats)
+        click.echo("generated distribution")
+        if distribution.undistributed:
+            click.echo(
+                f"{Decimal(distribution.undistributed) / WEI_PER_ETHER} CTX ({distribution.undistributed} wei) of the reward "
+                "could not be distributed, a keeper vote has no eligible delegators"
+            )
 
 
 @main.command()
-def generate_distribution():
-    click.echo("Building delegation records...")
-    BuildAccountDelegation().build()
-    click.echo("delegation records built")
-    click.echo("Building vote stats...")
-    VoteStatBuilder().build()
-    click.echo("Built vote stats")
-    click.echo("Generating distribution...")
-    GenerateDistribution().generate()
-    click.echo("generated distribution")
+@click.option("--database-url", default="sqlite://", show_default=True,
+              help="Empty database to run on, e.g. a scratch PostgreSQL database.")
+@click.option("--delegators", default=500, show_default=True)
+@click.option("--keepers", default=10, show_default=True)
+@click.option("--proposals", default=20, show_default=True)
+@click.option("--transactions", default=10_000, show_default=True)
+@click.option("--seed", default=1, show_default=True)
+@click.option("--output", default=None, help="Also write the results to this JSON file.")
+def benchmark(database_url, delegators, keepers, proposals, transactions, seed, output):
+    """Times every generate-distribution stage on a synthetic event history."""
+    results = run_benchmark(
+        database_url,
+        delegators=delegators,
+        keepers=keepers,
+        proposals=proposals,
+        transactions=transactions,
+        seed=seed,
+    )
+    click.echo(f"{'stage':<20}{'seconds':>10}{'queries':>10}{'db seconds':>12}{'peak MB':>10}")
+    for result in results:
+        click.echo(
+            f"{result['stage']:<20}{result['seconds']:>10.3f}{result['queries']:>10}"
+            f"{result['db_seconds']:>12.3f}{result['peak_memory_mb']:>10.1f}"
+        )
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
 
 
 if __name__ == "__main__":
@@ -22,6 +22,10 @@ setup(
         "SQLAlchemy>=2.0.25",
         "XlsxWriter>=3.1.9",
     ],
+    extras_require={
+        "parquet": ["pyarrow>=15.0.0"],
+        "test": ["openpyxl>=3.1.2", "pytest>=7.4.0"],
+    },
     python_requires=">=3.11.0",
     license="MIT",
     zip_safe=False,
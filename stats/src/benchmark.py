@@ -0,0 +1,309 @@
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import insert
+
+from .database import Session, use_database
+from .instrumentation import profiler
+from .models import (
+    DelegateChanged,
+    DelegationRecord,
+    DelegateVotesChanged,
+    Staked,
+    Transfer,
+    VoteCast,
+    Withdrawn,
+)
+from .stats import (
+    CRYPTEX_TEAM_MULTISIG_ADDRESS,
+    START_BLOCK,
+    BuildAccountDelegation,
+    GenerateDistribution,
+    VoteStatBuilder,
+)
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+START_TIMESTAMP = 1633453569
+SECONDS_PER_BLOCK = 13
+CTX = 10 ** 18
+# every transaction shape classified by BuildAccountDelegation.write_record
+SHAPES = [
+    "direct_delegation",
+    "delegate_switch",
+    "staked",
+    "staked_redelegation",
+    "transfer_out",
+    "transfer_in",
+    "exchange_buy",
+    "exchange_sell",
+    "multisig_distribution",
+    "multisig_transfer",
+    "withdrawn",
+    "withdrawn_redelegation",
+]
+
+
+def synthetic_address(prefix, number):
+    return "0x" + f"{prefix}{number:x}".rjust(40, "0")
+
+
+class HistoryGenerator:
+    """
+    Generates a consistent event history: delegators delegate to keepers
+    directly or by staking, move tokens around and withdraw, while keepers
+    (and sometimes the team multisig) vote on proposals. Event ids,
+    DelegateVotesChanged balances and log order follow the subgraph.
+    """
+
+    def __init__(self, delegators=50, keepers=5, proposals=6, transactions=600, seed=1):
+        self.rnd = random.Random(seed)
+        self.transactions = transactions
+        self.proposals = proposals
+        self.keepers = [synthetic_address("ee", i) for i in range(keepers)]
+        self.delegators = [synthetic_address("aa", i) for i in range(delegators)]
+        self.delegator_contracts = {keeper: synthetic_address("cc", i) for i, keeper in enumerate(self.keepers)}
+        self.votes = {keeper: 0 for keeper in self.keepers}
+        self.votes[CRYPTEX_TEAM_MULTISIG_ADDRESS] = 100_000 * CTX
+        self.wallets = {delegator: self.rnd.randint(1, 1000) * CTX for delegator in self.delegators}
+        # delegator -> keeper delegated to directly
+        self.direct_delegations = {}
+        # (delegator, keeper) -> amount staked
+        self.stakes = {}
+        self.solo_keepers = 0
+        self.block = START_BLOCK - 60_000
+        self.transaction_count = 0
+        self.events = {model: [] for model in [DelegateChanged, DelegateVotesChanged, Staked, Transfer, Withdrawn,
+                                               VoteCast]}
+
+    def generate(self):
+        voted = {proposal_id: set() for proposal_id in range(1, self.proposals + 1)}
+        vote_points = sorted(self.rnd.sample(range(self.transactions // 4, self.transactions), self.proposals * 2))
+        for i in range(self.transactions):
+            if vote_points and i == vote_points[0]:
+                vote_points.pop(0)
+                self.vote(voted)
+            else:
+                getattr(self, self.rnd.choice(SHAPES))(self.rnd.choice(self.delegators), self.rnd.choice(self.keepers))
+        return self.events
+
+    def new_transaction(self):
+        self.block += self.rnd.randint(100, 3000)
+        self.transaction_count += 1
+        transaction_hash = "0x" + f"{self.transaction_count:064x}"
+        return transaction_hash, self.block, START_TIMESTAMP + (self.block - START_BLOCK) * SECONDS_PER_BLOCK
+
+    def add_event(self, model, transaction, log_index, **fields):
+        transaction_hash, block_number, block_timestamp = transaction
+        self.events[model].append(dict(
+            id=transaction_hash + f"{log_index:08x}",
+            blockNumber=block_number,
+            blockTimestamp=block_timestamp,
+            transactionHash=transaction_hash,
+            **fields,
+        ))
+
+    def votes_changed(self, transaction, log_index, keeper, delta):
+        previous_balance = self.votes[keeper]
+        self.votes[keeper] = previous_balance + delta
+        self.add_event(
+            DelegateVotesChanged, transaction, log_index,
+            delegate=keeper, previousBalance=previous_balance, newBalance=previous_balance + delta,
+        )
+
+    def vote(self, voted):
+        proposal_id = self.rnd.randint(1, self.proposals)
+        voters = self.rnd.sample(self.keepers, self.rnd.randint(1, len(self.keepers)))
+        if self.rnd.random() < 0.3:
+            voters.append(CRYPTEX_TEAM_MULTISIG_ADDRESS)
+        for voter in voters:
+            if voter in voted[proposal_id]:
+                continue
+            voted[proposal_id].add(voter)
+            self.add_event(
+                VoteCast, self.new_transaction(), 0,
+                voter=voter, proposalId=proposal_id, support=True, votes=self.votes[voter],
+            )
+
+    def direct_delegation(self, delegator, keeper):
+        if delegator in self.direct_delegations:
+            return
+        transaction = self.new_transaction()
+        self.add_event(DelegateChanged, transaction, 0, delegator=delegator, fromDelegate=ZERO_ADDRESS,
+                       toDelegate=keeper)
+        self.votes_changed(transaction, 1, keeper, self.wallets[delegator])
+        self.direct_delegations[delegator] = keeper
+
+    def delegate_switch(self, delegator, keeper):
+        if delegator in self.direct_delegations:
+            return
+        # delegate to a keeper nobody else uses, then switch away from it
+        self.solo_keepers += 1
+        solo_keeper = synthetic_address("5010", self.solo_keepers)
+        self.votes[solo_keeper] = 0
+        transaction = self.new_transaction()
+        self.add_event(DelegateChanged, transaction, 0, delegator=delegator, fromDelegate=ZERO_ADDRESS,
+                       toDelegate=solo_keeper)
+        self.votes_changed(transaction, 1, solo_keeper, self.wallets[delegator])
+        transaction = self.new_transaction()
+        self.add_event(DelegateChanged, transaction, 0, delegator=delegator, fromDelegate=solo_keeper,
+                       toDelegate=keeper)
+        self.votes_changed(transaction, 1, solo_keeper, -self.wallets[delegator])
+        self.votes_changed(transaction, 2, keeper, self.wallets[delegator])
+        self.direct_delegations[delegator] = keeper
+
+    def staked(self, delegator, keeper, redelegation=False):
+        if redelegation and self.direct_delegations.get(delegator, keeper) == keeper:
+            return
+        if not redelegation and delegator in self.direct_delegations:
+            return
+        amount = self.rnd.randint(1, 100) * CTX
+        contract = self.delegator_contracts[keeper]
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=delegator, to=contract, amount=amount)
+        if redelegation:
+            self.votes_changed(transaction, 1, self.direct_delegations[delegator], -amount)
+        self.votes_changed(transaction, 2, keeper, amount)
+        self.add_event(Staked, transaction, 3, delegator=contract, delegatee=delegator, amount=amount)
+        self.stakes[(delegator, keeper)] = self.stakes.get((delegator, keeper), 0) + amount
+
+    def staked_redelegation(self, delegator, keeper):
+        self.staked(delegator, keeper, redelegation=True)
+
+    def withdrawn(self, delegator, keeper, redelegation=False):
+        stakes = sorted(stake for stake, amount in self.stakes.items() if amount > 0)
+        if not stakes:
+            return
+        delegator, keeper = self.rnd.choice(stakes)
+        if redelegation and self.direct_delegations.get(delegator, keeper) == keeper:
+            return
+        if not redelegation and delegator in self.direct_delegations:
+            return
+        amount = self.stakes[(delegator, keeper)]
+        contract = self.delegator_contracts[keeper]
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=contract, to=delegator, amount=amount)
+        self.votes_changed(transaction, 1, keeper, -amount)
+        if redelegation:
+            self.votes_changed(transaction, 2, self.direct_delegations[delegator], amount)
+        self.add_event(Withdrawn, transaction, 3, delegator=contract, delegatee=delegator, amount=amount)
+        self.stakes[(delegator, keeper)] = 0
+
+    def withdrawn_redelegation(self, delegator, keeper):
+        self.withdrawn(delegator, keeper, redelegation=True)
+
+    def transfer_out(self, delegator, keeper):
+        if delegator not in self.direct_delegations:
+            return
+        amount = self.rnd.randint(1, 10) * CTX // 10
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=delegator, to=synthetic_address("dd", self.rnd.randint(0, 9)),
+                       amount=amount)
+        self.votes_changed(transaction, 1, self.direct_delegations[delegator], -amount)
+
+    def transfer_in(self, delegator, keeper):
+        if delegator not in self.direct_delegations:
+            return
+        amount = self.rnd.randint(1, 10) * CTX // 10
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=synthetic_address("dd", self.rnd.randint(0, 9)), to=delegator,
+                       amount=amount)
+        self.votes_changed(transaction, 1, self.direct_delegations[delegator], amount)
+
+    def exchange_buy(self, delegator, keeper):
+        if delegator not in self.direct_delegations:
+            return
+        amount = self.rnd.randint(1, 10) * CTX // 10
+        pool, router = synthetic_address("b0", 1), synthetic_address("b0", 2)
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=pool, to=router, amount=amount)
+        self.add_event(Transfer, transaction, 1, from_=router, to=delegator, amount=amount)
+        self.votes_changed(transaction, 2, self.direct_delegations[delegator], amount)
+
+    def exchange_sell(self, delegator, keeper):
+        if delegator not in self.direct_delegations:
+            return
+        amount = self.rnd.randint(1, 10) * CTX // 10
+        pool, liquidity_provider = synthetic_address("b0", 1), synthetic_address("b0", 3)
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=delegator, to=pool, amount=amount)
+        self.add_event(Transfer, transaction, 1, from_=pool, to=liquidity_provider, amount=amount // 100)
+        self.votes_changed(transaction, 2, self.direct_delegations[delegator], -amount)
+
+    def multisig_transfer(self, delegator, keeper):
+        amount = self.rnd.randint(1, 10) * CTX
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=CRYPTEX_TEAM_MULTISIG_ADDRESS, to=synthetic_address("dd", 20),
+                       amount=amount)
+        self.votes_changed(transaction, 1, CRYPTEX_TEAM_MULTISIG_ADDRESS, -amount)
+
+    def multisig_distribution(self, delegator, keeper):
+        if delegator not in self.direct_delegations:
+            return
+        amount = self.rnd.randint(1, 10) * CTX + self.rnd.randint(1, 1000)
+        transaction = self.new_transaction()
+        self.add_event(Transfer, transaction, 0, from_=CRYPTEX_TEAM_MULTISIG_ADDRESS, to=delegator, amount=amount)
+        self.votes_changed(transaction, 1, CRYPTEX_TEAM_MULTISIG_ADDRESS, -amount)
+        self.votes_changed(transaction, 2, self.direct_delegations[delegator], amount)
+
+
+def load_history(session, events, batch_size=10_000):
+    for model, rows in events.items():
+        rows = sorted(rows, key=lambda row: row["id"])
+        for start in range(0, len(rows), batch_size):
+            session.execute(insert(model), rows[start:start + batch_size])
+    session.commit()
+
+
+def measure(stage, function, *args, **kwargs):
+    """
+    Runs function as a stage of the query profiler and returns its wall time,
+    number of statements and peak python memory.
+    """
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        with profiler.stage(stage) as stat:
+            function(*args, **kwargs)
+        seconds = time.perf_counter() - start_time
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(
+        stage=stage,
+        seconds=round(seconds, 3),
+        queries=stat.queries,
+        db_seconds=round(stat.seconds, 3),
+        peak_memory_mb=round(peak_memory / 2 ** 20, 1),
+    )
+
+
+def run_benchmark(database_url="sqlite://", delegators=50, keepers=5, proposals=6, transactions=600, seed=1):
+    """
+    Runs every stage of generate-distribution on a synthetic history in the
+    (empty) database at database_url and returns one result per stage. The
+    distribution files are written to a temporary directory.
+    """
+    use_database(database_url)
+    with Session() as session:
+        if session.query(DelegationRecord.id).first() or session.query(DelegateVotesChanged.id).first():
+            raise Exception("the benchmark needs an empty database")
+
+    events = HistoryGenerator(delegators, keepers, proposals, transactions, seed).generate()
+    profiler.enable()
+    profiler.reset()
+    results = []
+    with Session() as session:
+        results.append(measure("load", load_history, session, events))
+    results.append(measure("delegation records", BuildAccountDelegation().build))
+    results.append(measure("vote stats", VoteStatBuilder().build))
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            results.append(measure("distribution", GenerateDistribution().generate))
+        finally:
+            os.chdir(working_directory)
+    return results
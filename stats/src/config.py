@@ -9,3 +9,22 @@ load_dotenv(BASE_DIR / '.env')
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 GRAPH_QUERY_URL = os.getenv("GRAPH_QUERY_URL")
+# log every SQL statement
+SQL_ECHO = os.getenv("SQL_ECHO", "false").lower() in ("1", "true", "yes")
+# number of rows sent to the database in a single INSERT when bulk ingesting
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", 1000))
+# number of subgraph entity streams fetched in parallel
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", 7))
+# pages of a stream fetched ahead of its writers
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 4))
+# transaction hashes per transactionHash_in query when only the transfers of delegation transactions are fetched
+TRANSFER_HASH_BATCH_SIZE = int(os.getenv("TRANSFER_HASH_BATCH_SIZE", 100))
+# http settings for the subgraph endpoint
+GRAPH_REQUEST_TIMEOUT = float(os.getenv("GRAPH_REQUEST_TIMEOUT", 60))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", 8))
+GRAPH_BACKOFF_FACTOR = float(os.getenv("GRAPH_BACKOFF_FACTOR", 0.5))
+# budget of a batched query, in entities requested times fields, before it is split in several requests
+GRAPH_MAX_COMPLEXITY = int(os.getenv("GRAPH_MAX_COMPLEXITY", 50_000))
+# local parquet snapshot of the event tables, partitioned by block range
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshot")
+SNAPSHOT_PARTITION_BLOCKS = int(os.getenv("SNAPSHOT_PARTITION_BLOCKS", 100_000))
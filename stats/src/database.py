@@ -1,11 +1,49 @@
 from sqlalchemy import create_engine, Column, Integer, String, Sequence
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 
-from .config import DATABASE_URL
+from .config import DATABASE_URL, SQL_ECHO
 Base = declarative_base()
 
-engine = create_engine(DATABASE_URL, echo=True)
+engine = create_engine(DATABASE_URL, echo=SQL_ECHO)
 
 Session = sessionmaker(bind=engine)
 
+
+def use_database(url):
+    """
+    Points Session at the database at url, e.g. "sqlite://" for a private
+    in-memory database, and creates the tables there.
+    """
+    kwargs = dict()
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # every session has to share the one connection holding the in-memory database
+        kwargs = dict(connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    new_engine = create_engine(url, echo=engine.echo, **kwargs)
+    Base.metadata.create_all(new_engine)
+    Session.configure(bind=new_engine)
+    return new_engine
+
+
+INSERT_BUILDERS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def insert_ignore_duplicates(session, model, rows, index_elements=("id",)):
+    """
+    INSERT ... ON CONFLICT (index_elements) DO NOTHING for a list of row dicts,
+    sent as a single executemany.
+    """
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    try:
+        insert = INSERT_BUILDERS[dialect]
+    except KeyError:
+        raise Exception(f"bulk insert is not supported for the {dialect} dialect")
+    statement = insert(model).on_conflict_do_nothing(index_elements=list(index_elements))
+    session.execute(statement, rows)
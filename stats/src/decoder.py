@@ -0,0 +1,60 @@
+from operator import itemgetter
+
+from sqlalchemy import Boolean, Integer, String
+
+from .models import Amount
+
+# addresses and transaction hashes
+HEX_STRING_LENGTH = 66
+
+
+def column_converter(column):
+    """
+    Returns the function converting the subgraph's JSON value of a column to
+    its python value, or None when the value is stored as it is. BigInts are
+    sent as decimal strings and become exact ints, including wei amounts.
+    """
+    if isinstance(column.type, (Amount, Integer)):
+        return int
+    if isinstance(column.type, Boolean):
+        return bool
+    if isinstance(column.type, String) and column.type.length == HEX_STRING_LENGTH:
+        return str.lower
+    return None
+
+
+class PageDecoder:
+    """
+    Decodes a page of subgraph entities into one list per column of model,
+    with the conversion of every column chosen once, from its type, when the
+    decoder is built. `transformers` override the conversion of a field.
+    """
+
+    def __init__(self, model, fields, rename_fields=None, add_fields=None, transformers=None):
+        rename_fields = rename_fields or dict()
+        transformers = transformers or dict()
+        table_columns = model.__table__.c
+        # (column name, getter of the JSON field, converter)
+        self.columns = []
+        for field in fields:
+            name = rename_fields.get(field, field)
+            converter = transformers.get(field) or column_converter(table_columns[name])
+            self.columns.append((name, itemgetter(field), converter))
+        self.add_fields = add_fields or dict()
+
+    def decode(self, results):
+        columns = dict()
+        for name, getter, converter in self.columns:
+            values = map(getter, results)
+            columns[name] = list(map(converter, values) if converter else values)
+        for name, value in self.add_fields.items():
+            columns[name] = [value] * len(results)
+        return columns
+
+    def rows(self, results):
+        # SQLAlchemy only takes the parameters of an executemany INSERT as one
+        # dict per row, so the decoded columns are zipped back into rows here,
+        # the only per-row work left
+        columns = self.decode(results)
+        names = list(columns)
+        return [dict(zip(names, values)) for values in zip(*columns.values())]
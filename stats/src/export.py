@@ -0,0 +1,171 @@
+import json
+import re
+from decimal import Decimal
+
+import xlsxwriter
+
+EXPORT_FORMATS = ["xlsx", "csv", "parquet", "jsonl"]
+
+
+def import_pyarrow(purpose):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception(f"{purpose} needs pyarrow: pip install -e .[parquet]")
+    return pyarrow, pyarrow.parquet
+
+
+def iter_query_chunks(session, statement, chunk_size):
+    """
+    Yields the rows of statement in lists of at most chunk_size rows. On
+    PostgreSQL the rows are read through a server side cursor, so only one
+    chunk is held in memory at a time.
+    """
+    result = session.execute(statement, execution_options={"stream_results": True, "yield_per": chunk_size})
+    for rows in result.partitions():
+        yield rows
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return format(value, "f")
+    return str(value)
+
+
+def sheet_file_path(base_path, sheet_name, extension):
+    return f"{base_path}_{re.sub(r'[^a-z0-9]+', '_', sheet_name.lower())}.{extension}"
+
+
+class ExcelExporter:
+    """
+    Writes rows straight to disk with XlsxWriter's constant_memory mode.
+    Sheets have to be written one after another, each in row order.
+    """
+
+    def __init__(self, base_path):
+        self.workbook = xlsxwriter.Workbook(f"{base_path}.xlsx", {"constant_memory": True})
+        self.header_format = self.workbook.add_format({"bold": True})
+        self.worksheet = None
+        self.row = 0
+
+    def start_sheet(self, sheet_name, columns):
+        self.worksheet = self.workbook.add_worksheet(sheet_name)
+        self.worksheet.write_row(0, 0, columns, self.header_format)
+        self.row = 1
+
+    def write(self, df):
+        for values in df.itertuples(index=False):
+            self.worksheet.write_row(self.row, 0, values)
+            self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class CsvExporter:
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.path = None
+
+    def start_sheet(self, sheet_name, columns):
+        self.path = sheet_file_path(self.base_path, sheet_name, "csv")
+        with open(self.path, "w", newline="") as f:
+            f.write(",".join(columns) + "\n")
+
+    def write(self, df):
+        df.to_csv(self.path, mode="a", header=False, index=False)
+
+    def close(self):
+        pass
+
+
+class JsonLinesExporter:
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.file = None
+
+    def start_sheet(self, sheet_name, columns):
+        self.close()
+        self.file = open(sheet_file_path(self.base_path, sheet_name, "jsonl"), "w")
+
+    def write(self, df):
+        for record in df.to_dict(orient="records"):
+            self.file.write(json.dumps(record, default=json_default) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ParquetExporter:
+    """
+    One parquet file per sheet, written one row group per chunk. Decimal
+    columns are stored as decimal256(76, 18), wide enough for any ether amount.
+    """
+
+    def __init__(self, base_path):
+        self.pa, self.pq = import_pyarrow("parquet export")
+        self.base_path = base_path
+        self.path = None
+        self.writer = None
+        self.schema = None
+
+    def start_sheet(self, sheet_name, columns):
+        self.close()
+        self.path = sheet_file_path(self.base_path, sheet_name, "parquet")
+
+    def write(self, df):
+        if df.empty:
+            return
+        if self.writer is None:
+            schema = self.pa.Schema.from_pandas(df, preserve_index=False)
+            for column in df.columns:
+                if isinstance(df[column].iloc[0], Decimal):
+                    index = schema.get_field_index(column)
+                    schema = schema.set(index, self.pa.field(column, self.pa.decimal256(76, 18)))
+            self.schema = schema
+            self.writer = self.pq.ParquetWriter(self.path, self.schema, compression="zstd")
+        self.writer.write_table(self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+EXPORTERS = {
+    "xlsx": ExcelExporter,
+    "csv": CsvExporter,
+    "parquet": ParquetExporter,
+    "jsonl": JsonLinesExporter,
+}
+
+
+class StreamingExport:
+    """
+    Writes the same sheet to every requested format, chunk by chunk.
+    """
+
+    def __init__(self, base_path, formats):
+        self.exporters = [EXPORTERS[export_format](base_path) for export_format in formats]
+
+    def write_sheet(self, sheet_name, columns, chunks):
+        for exporter in self.exporters:
+            exporter.start_sheet(sheet_name, columns)
+        for df in chunks:
+            for exporter in self.exporters:
+                exporter.write(df)
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,162 +1,435 @@
-from sqlalchemy import desc
+import datetime
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from sqlalchemy import desc, func
+
+from .config import FETCH_CONCURRENCY, INSERT_BATCH_SIZE, TRANSFER_HASH_BATCH_SIZE
 from .database import Session
-from .graphql import DataCruncher
+from .graphql import DataCruncher, GraphClient, QueryBatcher, RateLimiter, create_http_session
 from .models import (
     DelegateChanged,
     DelegatorCreated,
     DelegateVotesChanged,
+    FetchShard,
     Staked,
+    SyncState,
     Transfer,
     VoteCast,
     Withdrawn,
 )
 
+# startBlock of the data sources in subgraph/subgraph.yaml
+CTX_START_BLOCK = 12183937
+DELEGATOR_FACTORY_START_BLOCK = 13360297
+GOVERNOR_START_BLOCK = 12184034
+
+STREAMS = {
+    "delegatorCreateds": dict(
+        model=DelegatorCreated,
+        fields=["id", "delegator", "delegatee", "blockNumber", "blockTimestamp", "transactionHash"],
+        start_block=DELEGATOR_FACTORY_START_BLOCK,
+    ),
+    "delegateChangeds": dict(
+        model=DelegateChanged,
+        fields=["id", "delegator", "fromDelegate", "toDelegate", "blockNumber", "blockTimestamp", "transactionHash"],
+        start_block=CTX_START_BLOCK,
+    ),
+    "delegateVotesChangeds": dict(
+        model=DelegateVotesChanged,
+        fields=["id", "delegate", "previousBalance", "newBalance", "blockNumber", "blockTimestamp", "transactionHash"],
+        start_block=CTX_START_BLOCK,
+    ),
+    "stakeds": dict(
+        model=Staked,
+        fields=["id", "delegator", "delegatee", "amount", "blockNumber", "blockTimestamp", "transactionHash"],
+        start_block=DELEGATOR_FACTORY_START_BLOCK,
+    ),
+    "transfers": dict(
+        model=Transfer,
+        fields=["id", "from", "to", "amount", "blockNumber", "blockTimestamp", "transactionHash"],
+        start_block=CTX_START_BLOCK,
+        rename_fields={"from": "from_"},
+    ),
+    "voteCasts": dict(
+        model=VoteCast,
+        fields=["id", "voter", "proposalId", "support", "votes", "blockNumber", "blockTimestamp", "transactionHash"],
+        start_block=GOVERNOR_START_BLOCK,
+    ),
+    "withdrawns": dict(
+        model=Withdrawn,
+        fields=["id", "delegator", "delegatee", "amount", "blockNumber", "blockTimestamp", "transactionHash"],
+        start_block=DELEGATOR_FACTORY_START_BLOCK,
+    ),
+}
+# "targeted" only fetches the transfers of transactions with a DelegateVotesChanged
+# event, the only ones the delegation records are built from; "full" fetches them all.
+TRANSFER_MODES = ["targeted", "full"]
+# the targeted transfer batches only store some transfers of the blocks they pass,
+# so they keep their own cursor and the full stream never resumes after them.
+TARGETED_TRANSFERS_KEY = "transfers:targeted"
+SYNC_STATE_KEYS = sorted([*STREAMS, TARGETED_TRANSFERS_KEY])
+# streams split into block range shards by default; the targeted mode never
+# fetches the transfers stream, so the largest of the other streams is split instead
+DEFAULT_SHARDED_STREAMS = {"targeted": ("delegateVotesChangeds",), "full": ("transfers",)}
 
-def fetch_and_write_delegator_created():
+
+def get_last_cursor(table_key):
+    """
+    Returns the (blockNumber, id) the stream resumes from, kept in sync_state.
+    Streams without a sync_state row, e.g. fetched before the table existed or
+    reset, get one from a single scan of the rows stored so far, except the
+    full transfers stream once targeted batches stored some of them.
+    """
     with Session() as session:
-        last_delegator_created = session.query(DelegatorCreated).order_by(desc(DelegatorCreated.blockNumber)).first()
+        state = session.get(SyncState, table_key)
+        if state is None:
+            model = Transfer if table_key == TARGETED_TRANSFERS_KEY else STREAMS[table_key]["model"]
+            last_entity = None
+            if table_key != "transfers" or session.get(SyncState, TARGETED_TRANSFERS_KEY) is None:
+                last_entity = session.query(model.blockNumber, model.id).order_by(
+                    desc(model.blockNumber), desc(model.id)
+                ).first()
+            state = session.merge(SyncState(
+                stream=table_key,
+                blockNumber=last_entity.blockNumber if last_entity else 0,
+                entity_id=last_entity.id if last_entity else None,
+                updated_at=datetime.datetime.now(),
+            ))
+            session.commit()
+        return state.blockNumber, state.entity_id
 
-    if last_delegator_created:
-        block_number = last_delegator_created.blockNumber
-    else:
-        block_number = 0
 
-    DataCruncher(
-        DelegatorCreated,
-        "delegatorCreateds",
-        ["id", "delegator", "delegatee", "blockNumber", "blockTimestamp", "transactionHash"],
-        "blockNumber",
-        block_number,
-        ignore_if_exists=["id"],
-    ).fetch_and_write_to_db()
+def get_last_block_number(table_key):
+    block_number, _ = get_last_cursor(table_key)
+    return block_number
+
 
+def advance_sync_state(session, table_key, results):
+    # called in the transaction that writes the page, so the cursor never gets
+    # ahead of the stored rows. Shards of a stream finish out of order, the
+    # cursor only moves forward.
+    if not results:
+        return
+    cursor = (int(results[-1]["blockNumber"]), results[-1]["id"])
+    state = session.get(SyncState, table_key, with_for_update=True)
+    if state is None:
+        session.add(SyncState(
+            stream=table_key, blockNumber=cursor[0], entity_id=cursor[1], updated_at=datetime.datetime.now()
+        ))
+    elif cursor > (state.blockNumber, state.entity_id or ""):
+        state.blockNumber, state.entity_id = cursor
+        state.updated_at = datetime.datetime.now()
 
-def fetch_and_write_delegator_changed():
+
+def mark_synced(table_key, block_number):
+    # the delegation records are only built up to the block all their streams are synced to
     with Session() as session:
-        last_delegator_changed = session.query(DelegateChanged).order_by(desc(DelegateChanged.blockNumber)).first()
+        state = session.get(SyncState, table_key, with_for_update=True)
+        if state is not None and (state.synced_block is None or state.synced_block < block_number):
+            state.synced_block = block_number
+            state.updated_at = datetime.datetime.now()
+            session.commit()
 
-    if last_delegator_changed:
-        block_number = last_delegator_changed.blockNumber
-    else:
-        block_number = 0
 
-    DataCruncher(
-        DelegateChanged,
-        "delegateChangeds",
-        ["id", "delegator", "fromDelegate", "toDelegate", "blockNumber", "blockTimestamp", "transactionHash"],
-        "blockNumber",
-        block_number,
-        ignore_if_exists=["id"],
-    ).fetch_and_write_to_db()
+def fetch_head_block(url=None, rate_limiter=None):
+    return GraphClient(url=url, rate_limiter=rate_limiter).fetch_head_block()
 
 
-def fetch_and_write_delegate_votes_changed():
+def list_sync_state():
     with Session() as session:
-        last_delegator_votes_changed = session.query(
-            DelegateVotesChanged).order_by(desc(DelegateVotesChanged.blockNumber)).first()
+        return session.query(SyncState).order_by(SyncState.stream).all()
+
+
+def reset_sync_state(table_keys):
+    with Session() as session:
+        session.query(SyncState).filter(SyncState.stream.in_(table_keys)).delete()
+        session.commit()
 
-    if last_delegator_votes_changed:
-        block_number = last_delegator_votes_changed.blockNumber
-    else:
-        block_number = 0
 
-    DataCruncher(
-        DelegateVotesChanged,
-        "delegateVotesChangeds",
-        ["id", "delegate", "previousBalance", "newBalance", "blockNumber", "blockTimestamp", "transactionHash"],
+def build_data_cruncher(table_key, block_number, composite_cursor=False, last_id=None, **kwargs):
+    stream = STREAMS[table_key]
+    return DataCruncher(
+        stream["model"],
+        table_key,
+        stream["fields"],
         "blockNumber",
         block_number,
+        rename_fields=stream.get("rename_fields", dict()),
+        # stored rows can be ahead of any cursor, e.g. the transfers of the targeted
+        # batches when the full transfers stream starts, so existing ids are always skipped
         ignore_if_exists=["id"],
-    ).fetch_and_write_to_db()
+        composite_cursor=composite_cursor,
+        last_id=last_id if composite_cursor else None,
+        **kwargs,
+    )
 
 
-def fetch_and_write_staked():
+def build_stream_cruncher(table_key, **kwargs):
+    block_number, last_id = get_last_cursor(table_key)
+
+    def checkpoint(session, results):
+        advance_sync_state(session, table_key, results)
+
+    return build_data_cruncher(table_key, block_number, last_id=last_id, checkpoint=checkpoint, **kwargs)
+
+
+def fetch_and_write_stream(table_key, **kwargs):
+    build_stream_cruncher(table_key, **kwargs).fetch_and_write_to_db()
+
+
+def fetch_and_write_delegator_created(**kwargs):
+    fetch_and_write_stream("delegatorCreateds", **kwargs)
+
+
+def fetch_and_write_delegator_changed(**kwargs):
+    fetch_and_write_stream("delegateChangeds", **kwargs)
+
+
+def fetch_and_write_delegate_votes_changed(**kwargs):
+    fetch_and_write_stream("delegateVotesChangeds", **kwargs)
+
+
+def fetch_and_write_staked(**kwargs):
+    fetch_and_write_stream("stakeds", **kwargs)
+
+
+def fetch_and_write_transfer(**kwargs):
+    fetch_and_write_stream("transfers", **kwargs)
+
+
+def build_transfer_batch_cruncher(transactions, **kwargs):
+    def checkpoint(session, results):
+        advance_sync_state(session, TARGETED_TRANSFERS_KEY, results)
+
+    tx_hashes = json.dumps(sorted({tx_hash for _, tx_hash in transactions}))
+    return build_data_cruncher(
+        "transfers",
+        transactions[0].blockNumber,
+        where=f"transactionHash_in: {tx_hashes}",
+        checkpoint=checkpoint,
+        **dict(kwargs, composite_cursor=True),
+    )
+
+
+def fetch_and_write_transfers_of_delegations(hash_batch_size=TRANSFER_HASH_BATCH_SIZE, batcher=None, **kwargs):
+    """
+    Fetches the transfers of the transactions that have a DelegateVotesChanged
+    event, hash_batch_size transactions per transactionHash_in query, so
+    delegateVotesChangeds must be fetched first. The batches are written in
+    block order, so a later run resumes from the block of their own cursor;
+    transactions without transfers after it are queried again.
+    """
+    from_block = get_last_block_number(TARGETED_TRANSFERS_KEY)
     with Session() as session:
-        last_staked = session.query(
-            Staked).order_by(desc(Staked.blockNumber)).first()
+        transactions = session.query(
+            DelegateVotesChanged.blockNumber, DelegateVotesChanged.transactionHash
+        ).filter(DelegateVotesChanged.blockNumber >= from_block).distinct().order_by(
+            DelegateVotesChanged.blockNumber, DelegateVotesChanged.transactionHash
+        ).all()
 
-    if last_staked:
-        block_number = last_staked.blockNumber
-    else:
-        block_number = 0
+    http_session = create_http_session()
+    for start in range(0, len(transactions), hash_batch_size):
+        task = (build_transfer_batch_cruncher, transactions[start:start + hash_batch_size], None)
+        if batcher is not None:
+            # one batch at a time, so the batches are still written in block order
+            fetch_and_write_batched([task], batcher=batcher, **kwargs)
+        else:
+            run_task(*task, http_session=http_session, **kwargs)
 
-    DataCruncher(
-        Staked,
-        "stakeds",
-        ["id", "delegator", "delegatee", "amount", "blockNumber", "blockTimestamp", "transactionHash"],
-        "blockNumber",
-        block_number,
-        ignore_if_exists=["id"],
-    ).fetch_and_write_to_db()
+
+def fetch_and_write_withdrawn(**kwargs):
+    fetch_and_write_stream("withdrawns", **kwargs)
+
+
+def fetch_and_write_vote_cast(**kwargs):
+    fetch_and_write_stream("voteCasts", **kwargs)
 
 
-def fetch_and_write_transfer():
+def has_pending_shards(table_key):
     with Session() as session:
-        last_transfer = session.query(
-            Transfer).order_by(desc(Transfer.blockNumber)).first()
+        return session.query(FetchShard.id).filter(
+            FetchShard.table_key == table_key, FetchShard.completed.is_(False)
+        ).first() is not None
 
-    if last_transfer:
-        block_number = last_transfer.blockNumber
-    else:
-        block_number = 0
 
-    DataCruncher(
-        Transfer,
-        "transfers",
-        ["id", "from", "to", "amount", "blockNumber", "blockTimestamp", "transactionHash"],
-        "blockNumber",
-        block_number,
-        rename_fields={"from": "from_"},
-        ignore_if_exists=["id"],
-    ).fetch_and_write_to_db()
+def plan_shards(table_key, shards, url=None, rate_limiter=None):
+    """
+    Returns the ids of the shards that still have to be fetched for table_key.
+    Unfinished shards of an earlier run are resumed as they are, otherwise
+    [last fetched block, head] is split into `shards` disjoint block ranges.
+    """
+    with Session() as session:
+        pending_shards = session.query(FetchShard.id).filter(
+            FetchShard.table_key == table_key, FetchShard.completed.is_(False)
+        ).order_by(FetchShard.start_block).all()
+        if pending_shards:
+            return [shard_id for shard_id, in pending_shards]
+        last_end_block = session.query(func.max(FetchShard.end_block)).filter(
+            FetchShard.table_key == table_key
+        ).scalar()
 
+    stream = STREAMS[table_key]
+    last_block, last_id = get_last_cursor(table_key)
+    start_block = max(stream["start_block"], last_block, last_end_block or 0)
+    end_block = fetch_head_block(url=url, rate_limiter=rate_limiter) + 1
+    if start_block >= end_block:
+        return []
 
-def fetch_and_write_withdrawn():
+    step = math.ceil((end_block - start_block) / shards)
     with Session() as session:
-        last_transfer = session.query(
-            Withdrawn).order_by(desc(Withdrawn.blockNumber)).first()
+        new_shards = [
+            FetchShard(
+                table_key=table_key,
+                start_block=shard_start,
+                end_block=min(shard_start + step, end_block),
+                cursor=shard_start,
+                # the first shard starts in the block of the last stored entity, after that entity
+                cursor_id=last_id if shard_start == last_block else None,
+                completed=False,
+            )
+            for shard_start in range(start_block, end_block, step)
+        ]
+        session.add_all(new_shards)
+        session.commit()
+        return [shard.id for shard in new_shards]
 
-    if last_transfer:
-        block_number = last_transfer.blockNumber
-    else:
-        block_number = 0
 
-    DataCruncher(
-        Withdrawn,
-        "withdrawns",
-        ["id", "delegator", "delegatee", "amount", "blockNumber", "blockTimestamp", "transactionHash"],
-        "blockNumber",
-        block_number,
-        ignore_if_exists=["id"],
-    ).fetch_and_write_to_db()
+def build_shard_cruncher(shard_id, **kwargs):
+    with Session() as session:
+        shard = session.get(FetchShard, shard_id)
+        table_key, cursor, cursor_id, end_block = shard.table_key, shard.cursor, shard.cursor_id, shard.end_block
+
+    def checkpoint(session, results):
+        if results:
+            session.query(FetchShard).filter(FetchShard.id == shard_id).update({
+                FetchShard.cursor: int(results[-1]["blockNumber"]),
+                FetchShard.cursor_id: results[-1]["id"],
+            })
+            advance_sync_state(session, table_key, results)
+
+    return build_data_cruncher(
+        table_key, cursor, last_id=cursor_id, page_value_lt=end_block, checkpoint=checkpoint, **kwargs
+    )
 
 
-def fetch_and_write_vote_cast():
+def complete_shard(shard_id):
     with Session() as session:
-        last_vote_cast = session.query(
-            VoteCast).order_by(desc(VoteCast.blockNumber)).first()
+        session.query(FetchShard).filter(FetchShard.id == shard_id).update({FetchShard.completed: True})
+        session.commit()
 
-    if last_vote_cast:
-        block_number = last_vote_cast.blockNumber
-    else:
-        block_number = 0
 
-    DataCruncher(
-        VoteCast,
-        "voteCasts",
-        ["id", "voter", "proposalId", "support", "votes", "blockNumber", "blockTimestamp", "transactionHash"],
-        "blockNumber",
-        block_number,
-        ignore_if_exists=["id"],
-    ).fetch_and_write_to_db()
+def fetch_and_write_shard(shard_id, **kwargs):
+    build_shard_cruncher(shard_id, **kwargs).fetch_and_write_to_db()
+    complete_shard(shard_id)
+
+
+def run_task(build, argument, finish, **kwargs):
+    build(argument, **kwargs).fetch_and_write_to_db()
+    if finish is not None:
+        finish(argument)
+
+
+def fetch_and_write_batched(tasks, batcher=None, url=None, rate_limiter=None, **kwargs):
+    """
+    Fetches the streams and shards of `tasks` together: every request carries
+    the next page of each of them under its own alias, so small streams are
+    done after a couple of requests instead of costing a round trip per page
+    each. Returns the number of requests made.
+    """
+    batcher = batcher or QueryBatcher(url=url, rate_limiter=rate_limiter)
+    active = []
+    for build, argument, finish in tasks:
+        cruncher = build(argument, url=url, rate_limiter=rate_limiter, **kwargs)
+        active.append((cruncher, cruncher.query_handler.create_cursor(), finish, argument))
+    while active:
+        pages = batcher.fetch_pages([
+            (cruncher.query_handler.table_key, cruncher.query_handler.fields, cursor) for cruncher, cursor, *_ in active
+        ])
+        for (cruncher, cursor, finish, argument), results in zip(active, pages):
+            if results:
+                cruncher.write_page(results)
+            cursor.advance(results)
+            if cursor.done and finish is not None:
+                finish(argument)
+        active = [task for task in active if not task[1].done]
+    return batcher.requests
+
+
+def fetch_all_data(
+        bulk=True,
+        batch_size=INSERT_BATCH_SIZE,
+        concurrency=FETCH_CONCURRENCY,
+        progress=None,
+        shards=1,
+        sharded_streams=None,
+        url=None,
+        composite_cursor=True,
+        transfers="targeted",
+        batch_queries=False,
+        writers=1,
+):
+    if sharded_streams is None:
+        sharded_streams = DEFAULT_SHARDED_STREAMS[transfers]
+    elif shards > 1 and transfers == "targeted" and "transfers" in sharded_streams:
+        raise Exception("the targeted transfers are not fetched in shards, shard them with --transfers full")
+    # every stream resumes from its own checkpoint, so the streams (and the
+    # block range shards of a stream) are independent and can be fetched in parallel.
+    # one limiter for every request to the endpoint, so that a 429 slows down all
+    # streams, shards and transfer batches instead of only the one that got it
+    rate_limiter = RateLimiter()
+    kwargs = dict(
+        bulk=bulk,
+        batch_size=batch_size,
+        progress=progress,
+        url=url,
+        composite_cursor=composite_cursor,
+        writers=writers,
+        rate_limiter=rate_limiter,
+    )
+    # every stream fetched to the end holds all entities up to this block
+    head_block = fetch_head_block(url=url, rate_limiter=rate_limiter)
+    tasks = []
+    synced_blocks = dict()
+    for table_key in STREAMS:
+        if table_key == "transfers" and transfers == "targeted":
+            continue
+        # unfinished shards are always completed first, otherwise resuming
+        # from the last stored block could skip the gaps they left behind.
+        if has_pending_shards(table_key) or (shards > 1 and table_key in sharded_streams):
+            shard_ids = plan_shards(table_key, shards, url=url, rate_limiter=rate_limiter)
+            tasks.extend((build_shard_cruncher, shard_id, complete_shard) for shard_id in shard_ids)
+            # resumed shards end at the head block of the run that planned them
+            with Session() as session:
+                end_block = session.query(func.max(FetchShard.end_block)).filter(
+                    FetchShard.table_key == table_key
+                ).scalar()
+            synced_blocks[table_key] = min(head_block, end_block - 1) if end_block else head_block
+        else:
+            tasks.append((build_stream_cruncher, table_key, None))
+            synced_blocks[table_key] = head_block
+
+    batcher = QueryBatcher(url=url, rate_limiter=rate_limiter) if batch_queries else None
+    if batch_queries:
+        fetch_and_write_batched(tasks, batcher=batcher, **kwargs)
+    elif concurrency <= 1:
+        for task in tasks:
+            run_task(*task, **kwargs)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(run_task, *task, **kwargs) for task in tasks]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                executor.shutdown(cancel_futures=True)
+                raise
+    for table_key, synced_block in synced_blocks.items():
+        mark_synced(table_key, synced_block)
 
+    if transfers == "targeted":
+        # needs the transaction hashes of all delegateVotesChangeds fetched above
+        fetch_and_write_transfers_of_delegations(batcher=batcher, **kwargs)
+        mark_synced(TARGETED_TRANSFERS_KEY, synced_blocks["delegateVotesChangeds"])
 
-def fetch_all_data():
-    fetch_and_write_delegator_created()
-    fetch_and_write_delegator_changed()
-    fetch_and_write_delegate_votes_changed()
-    fetch_and_write_staked()
-    fetch_and_write_transfer()
-    fetch_and_write_vote_cast()
-    fetch_and_write_withdrawn()
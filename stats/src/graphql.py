@@ -1,72 +1,380 @@
+import queue
+import random
+import threading
 import time
-import json
-from collections import defaultdict
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from .config import GRAPH_QUERY_URL
-from .database import Session
-from .utils import identity
+from .config import (
+    GRAPH_BACKOFF_FACTOR,
+    GRAPH_MAX_COMPLEXITY,
+    GRAPH_MAX_RETRIES,
+    GRAPH_QUERY_URL,
+    GRAPH_REQUEST_TIMEOUT,
+    INSERT_BATCH_SIZE,
+    PIPELINE_QUEUE_SIZE,
+)
+from .database import Session, insert_ignore_duplicates
+from .decoder import PageDecoder
 
-QUERY = """
+FILTERED_QUERY = """
 {{
-  {table_key} ( first: {first}, orderBy: {page_key} , where: {{ {page_key}_gte: "{page_value}" }} ) {{
+  {table_key} ( first: {first}, orderBy: {order_by} , where: {{ {where} }} ) {{
     {fields}
   }}
 }}
 """
+# one collection of a batched document, the response is keyed by alias
+ALIASED_SELECTION = """
+  {alias}: {table_key} ( first: {first}, orderBy: {order_by} , where: {{ {where} }} ) {{
+    {fields}
+  }}"""
+HEAD_BLOCK_QUERY = """
+{
+  _meta {
+    block {
+      number
+    }
+  }
+}
+"""
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_BACKOFF = 60
 
 
-class GraphQueryHandler:
+class RateLimiter:
+    """
+    Adaptive spacing between requests: the interval doubles every time the
+    server pushes back (429, 5xx, dropped connections) and halves again on
+    every successful response, down to min_interval.
+    """
+
+    def __init__(self, min_interval=0.0, max_interval=10.0, initial_throttle_interval=0.05):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_throttle_interval = initial_throttle_interval
+        self.interval = min_interval
+        self.next_request_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(self):
+        with self.lock:
+            self.interval = min(self.max_interval, max(self.interval * 2, self.initial_throttle_interval))
+
+    def relax(self):
+        with self.lock:
+            interval = self.interval / 2
+            self.interval = self.min_interval if interval < self.initial_throttle_interval else interval
+
+
+def create_http_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Content-Type": "application/json",
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+class PageCursor:
+    """
+    Position of a paged collection query. next_page() returns the orderBy and
+    where arguments of the next page and advance() moves past its results, so
+    a page can be fetched on its own or together with the pages of other
+    collections in one request.
+    """
+
+    def __init__(
+            self, page_key, page_value, page_size, page_value_lt=None, composite_cursor=False, last_id=None, where=None
+    ):
+        self.page_key = page_key
+        self.page_value = page_value
+        self.page_size = page_size
+        self.page_value_lt = page_value_lt
+        self.composite_cursor = composite_cursor
+        self.last_id = last_id if composite_cursor else None
+        self.where = where
+        self.done = False
+
+    def next_page(self):
+        if self.last_id is None:
+            where = f'{self.page_key}_gte: "{self.page_value}"'
+            return self.page_key, where + self._upper_bound() + self._extra_filter()
+        # the rest of the block the previous page stopped in and the blocks after it, in one page;
+        # graph-node doesn't combine or with other filters, so they are repeated in both branches
+        later_blocks = f'{self.page_key}_gt: "{self.page_value}"' + self._upper_bound() + self._extra_filter()
+        same_block = f'{self.page_key}: "{self.page_value}", id_gt: "{self.last_id}"' + self._extra_filter()
+        return self.page_key, f"or: [{{{later_blocks}}}, {{{same_block}}}]"
+
+    def advance(self, results):
+        if not self.composite_cursor:
+            self.page_value = results[-1][self.page_key] if results else 0
+        elif results:
+            # graph-node breaks ties in orderBy by id, so (page_key, id) is a strict
+            # total order and every entity is returned exactly once, even when a
+            # single block holds more than page_size entities.
+            self.page_value, self.last_id = results[-1][self.page_key], results[-1]["id"]
+        self.done = len(results) < self.page_size
+
+    def _upper_bound(self):
+        if self.page_value_lt is None:
+            return ""
+        return f', {self.page_key}_lt: "{self.page_value_lt}"'
+
+    def _extra_filter(self):
+        if self.where is None:
+            return ""
+        return f", {self.where}"
 
-    def __init__(self, table_key, fields, page_key, page_value, page_size=1000, url=None):
+
+class GraphClient:
+    """
+    Sends queries to the subgraph endpoint over one keep-alive connection pool,
+    paced by rate_limiter and retried with backoff on dropped connections,
+    429s and 5xx responses.
+    """
+
+    def __init__(
+            self,
+            url=None,
+            http_session=None,
+            rate_limiter=None,
+            timeout=GRAPH_REQUEST_TIMEOUT,
+            max_retries=GRAPH_MAX_RETRIES,
+            backoff_factor=GRAPH_BACKOFF_FACTOR,
+    ):
         if url is None:
             self.url = GRAPH_QUERY_URL
         else:
             self.url = url
+        self.http_session = http_session or create_http_session()
+        # shared by every client of a fetch, so they all slow down when the endpoint pushes back
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+    def request(self, query):
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            try:
+                response = self.http_session.post(self.url, json={"query": query}, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                self._backoff(attempt)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    self.rate_limiter.relax()
+                    return response.json()
+                self._backoff(attempt, response.headers.get("Retry-After"))
+            attempt += 1
+
+    def fetch_head_block(self):
+        response = self.request(HEAD_BLOCK_QUERY)
+        try:
+            return int(response["data"]["_meta"]["block"]["number"])
+        except KeyError:
+            raise Exception(response)
+
+    def _backoff(self, attempt, retry_after=None):
+        self.rate_limiter.throttle()
+        # exponential backoff with full jitter, unless the server says how long to wait;
+        # both are capped so a large Retry-After can't stall the stream indefinitely
+        if retry_after is not None and retry_after.isdigit():
+            delay = min(MAX_BACKOFF, int(retry_after))
+        else:
+            delay = random.uniform(0, min(MAX_BACKOFF, self.backoff_factor * 2 ** attempt))
+        time.sleep(delay)
+
+
+class GraphQueryHandler:
+
+    def __init__(
+            self,
+            table_key,
+            fields,
+            page_key,
+            page_value,
+            page_size=1000,
+            url=None,
+            page_value_lt=None,
+            composite_cursor=False,
+            last_id=None,
+            where=None,
+            http_session=None,
+            rate_limiter=None,
+    ):
+        # one client, and so one connection pool, per handler instead of a new connection per page
+        self.client = GraphClient(url=url, http_session=http_session, rate_limiter=rate_limiter)
         self.table_key = table_key
         self.page_key = page_key
         self.page_value = page_value
+        # exclusive upper bound on page_key, used to fetch a single block range shard
+        self.page_value_lt = page_value_lt
+        # page on (page_key, id) instead of page_key_gte; last_id is the id of the
+        # last entity already fetched in block page_value.
+        self.composite_cursor = composite_cursor
+        self.last_id = last_id
+        # extra filter added to every page, e.g. 'transactionHash_in: ["0x..."]'
+        self.where = where
         self.fields = fields
         self.page_size = page_size
 
+    def create_cursor(self):
+        return PageCursor(
+            self.page_key,
+            self.page_value,
+            self.page_size,
+            page_value_lt=self.page_value_lt,
+            composite_cursor=self.composite_cursor,
+            last_id=self.last_id,
+            where=self.where,
+        )
+
     def fetch_results(self):
-        page_value = self.page_value
-        results_len = self.page_size
-        while results_len == self.page_size:
-            query = QUERY.format(
-                table_key=self.table_key,
-                first=self.page_size,
-                page_key=self.page_key,
-                page_value=page_value,
-                fields='\n'.join(self.fields)
-            )
-            # https://stackoverflow.com/questions/52051989/requests-exceptions-connectionerror-connection-aborted-connectionreseterro
-            time.sleep(0.01)
-            response = self._make_request(query)
+        cursor = self.create_cursor()
+        while not cursor.done:
+            order_by, where = cursor.next_page()
+            results = self._query_page(order_by, where, cursor.page_size)
+            if results:
+                yield results
+            cursor.advance(results)
+
+    def _query_page(self, order_by, where, first):
+        query = FILTERED_QUERY.format(
+            table_key=self.table_key,
+            first=first,
+            order_by=order_by,
+            where=where,
+            fields='\n'.join(self.fields)
+        )
+        response = self.client.request(query)
+        try:
+            return response["data"][self.table_key]
+        except KeyError:
+            raise Exception(response)
+
+
+class QueryBatcher:
+    """
+    Fetches the next page of several cursors, of one or more collections, in
+    as few requests as possible: the pages are packed under aliases into
+    documents whose estimated complexity, entities requested times fields,
+    stays within max_complexity. When the indexer still rejects a document as
+    too expensive the budget is halved and the pages are packed again.
+    """
+
+    def __init__(self, url=None, max_complexity=GRAPH_MAX_COMPLEXITY, http_session=None, rate_limiter=None):
+        self.client = GraphClient(url=url, http_session=http_session, rate_limiter=rate_limiter)
+        self.max_complexity = max_complexity
+        self.requests = 0
+
+    def fetch_pages(self, pages):
+        """
+        pages is a list of (table_key, fields, cursor). Returns the results of
+        the next page of every cursor, in the same order.
+        """
+        results = []
+        while len(results) < len(pages):
+            batch = self._pack(pages[len(results):])
+            selections = []
+            for alias, (table_key, fields, cursor) in enumerate(batch):
+                order_by, where = cursor.next_page()
+                selections.append(ALIASED_SELECTION.format(
+                    alias=f"p{alias}",
+                    table_key=table_key,
+                    first=cursor.page_size,
+                    order_by=order_by,
+                    where=where,
+                    fields='\n'.join(fields),
+                ))
+            response = self.client.request("{" + "".join(selections) + "\n}")
+            self.requests += 1
+            if self._too_complex(response) and (len(batch) > 1 or batch[0][2].page_size > 1):
+                self.max_complexity = max(1, self.max_complexity // 2)
+                continue
             try:
-                results = response["data"][self.table_key]
-            except KeyError:
+                results.extend(response["data"][f"p{alias}"] for alias in range(len(batch)))
+            except (KeyError, TypeError):
                 raise Exception(response)
+        return results
 
-            yield results
-            page_value = results[-1][self.page_key] if results else 0
-            results_len = len(results)
-
-    def _make_request(self, query):
-        response = requests.post(
-            self.url,
-            data=json.dumps({"query": query}),
-            headers={
-               "Content-Type": "application/json"
-            }
+    def _pack(self, pages):
+        batch, complexity = [], 0
+        for table_key, fields, cursor in pages:
+            page_complexity = cursor.page_size * len(fields)
+            if batch and complexity + page_complexity > self.max_complexity:
+                break
+            if page_complexity > self.max_complexity:
+                # a page that doesn't fit on its own is made smaller
+                cursor.page_size = max(1, self.max_complexity // len(fields))
+                page_complexity = cursor.page_size * len(fields)
+            batch.append((table_key, fields, cursor))
+            complexity += page_complexity
+        return batch
+
+    @staticmethod
+    def _too_complex(response):
+        return any(
+            "complexity" in error.get("message", "") or "exceeds" in error.get("message", "")
+            for error in response.get("errors") or []
         )
-        response.raise_for_status()
-        return response.json()
+
+
+class OrderedCheckpoint:
+    """
+    Commits the checkpoint of the pages written by several writers in page
+    order: a page's cursor is only stored once it and every earlier page are
+    in the database, so a restart never skips a page that was still in flight.
+    """
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.next_index = 0
+        self.written_pages = dict()
+        self.lock = threading.Lock()
+
+    def page_written(self, index, results):
+        with self.lock:
+            self.written_pages[index] = results
+            last_results = None
+            while self.next_index in self.written_pages:
+                last_results = self.written_pages.pop(self.next_index)
+                self.next_index += 1
+            if last_results is not None:
+                with Session() as session:
+                    self.checkpoint(session, last_results)
+                    session.commit()
+
+
+def put_unless_stopped(pages, item, stop):
+    # blocks while the queue is full, which holds the fetcher back when the writers fall behind
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
 
 
 class DataCruncher:
-    transformers = defaultdict(lambda: identity)
 
     def __init__(
             self,
@@ -79,50 +387,147 @@ class DataCruncher:
             add_fields=dict(),
             transformers=dict(),
             rename_fields=dict(),
-            url=None
+            url=None,
+            bulk=False,
+            batch_size=INSERT_BATCH_SIZE,
+            progress=None,
+            page_value_lt=None,
+            checkpoint=None,
+            composite_cursor=False,
+            last_id=None,
+            where=None,
+            http_session=None,
+            rate_limiter=None,
+            writers=0,
+            queue_size=PIPELINE_QUEUE_SIZE,
     ):
         self.model = model
-        self.transformers.update(transformers)
-        self.rename_fields = rename_fields
-        self.add_fields = add_fields
+        self.decoder = PageDecoder(
+            model, fields, rename_fields=rename_fields, add_fields=add_fields, transformers=transformers
+        )
         self.ignore_if_exists = ignore_if_exists
+        self.bulk = bulk
+        self.batch_size = batch_size
+        self.progress = progress
+        # called with (session, results) in the transaction that writes a page
+        self.checkpoint = checkpoint
+        # number of threads writing the pages while the next ones are fetched, 0 alternates fetching and writing
+        self.writers = writers
+        self.queue_size = queue_size
         self.query_handler = GraphQueryHandler(
-            table_key, fields, page_key, page_value, url=url
+            table_key,
+            fields,
+            page_key,
+            page_value,
+            url=url,
+            page_value_lt=page_value_lt,
+            composite_cursor=composite_cursor,
+            last_id=last_id,
+            where=where,
+            http_session=http_session,
+            rate_limiter=rate_limiter,
         )
 
     def fetch_and_write_to_db(self):
+        if self.writers > 0:
+            self._fetch_and_write_pipelined()
+            return
         for results in self.query_handler.fetch_results():
-            for result in results:
-                transformed_data = self._transform_data(result)
-                data = self._add_fields(transformed_data)
-                renamed_data = self._rename_fields(data)
-                if self._ignore_if_exists(renamed_data):
+            self.write_page(results)
+
+    def _fetch_and_write_pipelined(self):
+        """
+        Fetches the pages in this thread and hands them to writer threads
+        through a bounded queue. A single writer stores the checkpoint in the
+        transaction of each page; several writers commit the pages out of
+        order, so their checkpoints are stored by an OrderedCheckpoint. The
+        first error stops both sides and is raised here.
+        """
+        # rows that already exist are only skipped safely by concurrent writers in bulk mode
+        writers = self.writers if self.bulk else 1
+        ordered_checkpoint = OrderedCheckpoint(self.checkpoint) if writers > 1 and self.checkpoint else None
+        pages = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+
+        def write():
+            while not stop.is_set():
+                try:
+                    item = pages.get(timeout=0.1)
+                except queue.Empty:
                     continue
-                with Session() as session:
-                    instance = self.model(**renamed_data)
-                    session.add(instance)
-                    session.commit()
+                if item is None:
+                    return
+                index, results = item
+                try:
+                    if writers == 1:
+                        self.write_page(results)
+                    else:
+                        self.write_page(results, checkpoint=False)
+                        if ordered_checkpoint is not None:
+                            ordered_checkpoint.page_written(index, results)
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
 
-    def _ignore_if_exists(self, data):
-        if not self.ignore_if_exists:
-            return
-        with Session() as session:
-            result = session.query(self.model).filter_by(**{key: data[key] for key in self.ignore_if_exists}).first()
-        return result is not None
+        threads = [threading.Thread(target=write, daemon=True) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for index, results in enumerate(self.query_handler.fetch_results()):
+                if not put_unless_stopped(pages, (index, results), stop):
+                    break
+        except Exception as e:
+            # the pages fetched so far are still written
+            errors.append(e)
+        finally:
+            for _ in threads:
+                put_unless_stopped(pages, None, stop)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
 
-    def _rename_fields(self, data):
-        new_dict = dict()
-        for key in data:
-            if key in self.rename_fields:
-                new_dict[self.rename_fields[key]] = data[key]
-            else:
-                new_dict[key] = data[key]
-        return new_dict
+    def write_page(self, results, checkpoint=True):
+        if self.bulk:
+            self._bulk_write(results, checkpoint)
+        else:
+            self._write_rows(results, checkpoint)
+        if self.progress is not None:
+            self.progress(self.query_handler.table_key, len(results))
 
-    def _transform_data(self, data):
-        return dict(
-            map(lambda key: (key, self.transformers[key](data[key])), data)
-        )
+    def _write_rows(self, results, checkpoint=True):
+        # the rows are inserted one at a time, but committed with the page's
+        # checkpoint, so an interrupted page never leaves rows past the cursor
+        with Session() as session:
+            for row in self.decoder.rows(results):
+                if self._ignore_if_exists(session, row):
+                    continue
+                session.add(self.model(**row))
+                session.flush()
+            if checkpoint and self.checkpoint is not None:
+                self.checkpoint(session, results)
+            session.commit()
 
-    def _add_fields(self, data):
-        return data | self.add_fields
+    def _bulk_write(self, results, checkpoint=True):
+        # the whole page is written in one transaction; rows that already exist
+        # (page boundaries, restarts) are skipped by the database instead of
+        # being looked up one by one.
+        rows = self.decoder.rows(results)
+        with Session() as session:
+            for start in range(0, len(rows), self.batch_size):
+                insert_ignore_duplicates(
+                    session,
+                    self.model,
+                    rows[start:start + self.batch_size],
+                    index_elements=self.ignore_if_exists or ["id"],
+                )
+            if checkpoint and self.checkpoint is not None:
+                self.checkpoint(session, results)
+            session.commit()
+
+    def _ignore_if_exists(self, session, data):
+        if not self.ignore_if_exists:
+            return
+        result = session.query(self.model).filter_by(**{key: data[key] for key in self.ignore_if_exists}).first()
+        return result is not None
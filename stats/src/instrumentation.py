@@ -0,0 +1,136 @@
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+# frames in these modules are never reported as the call site of a query
+SKIPPED_MODULES = {"database", "instrumentation"}
+
+
+@dataclass
+class QueryStat:
+    queries: int = 0
+    seconds: float = 0.0
+    rows_fetched: int = 0
+    rows_written: int = 0
+
+    def add(self, seconds, rows_fetched, rows_written):
+        self.queries += 1
+        self.seconds += seconds
+        self.rows_fetched += rows_fetched
+        self.rows_written += rows_written
+
+
+def find_call_site():
+    """
+    Returns module.function of the innermost frame of this package that is
+    not part of the database plumbing, e.g. stats.fetch_transactions.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if os.path.dirname(filename) == SOURCE_DIR:
+            module = os.path.splitext(os.path.basename(filename))[0]
+            if module not in SKIPPED_MODULES:
+                return f"{module}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "other"
+
+
+class QueryProfiler:
+    """
+    Counts the statements of every engine and the time spent in them, per
+    stage and per call site, through SQLAlchemy's cursor execute events.
+    Only active between enable() and disable(). Rows fetched are counted where
+    the driver reports a row count for SELECTs (psycopg2 does, sqlite3 doesn't).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.current_stage = "other"
+        self.lock = threading.Lock()
+        self.stages = defaultdict(QueryStat)
+        self.call_sites = defaultdict(QueryStat)
+
+    def enable(self):
+        if not self.enabled:
+            event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+            self.enabled = True
+
+    def disable(self):
+        if self.enabled:
+            event.remove(Engine, "before_cursor_execute", self.before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", self.after_cursor_execute)
+            self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.call_sites.clear()
+
+    @contextmanager
+    def stage(self, name):
+        # stages run one after another, the threads of a stage all report to it
+        previous_stage, self.current_stage = self.current_stage, name
+        try:
+            yield self.stages[name]
+        finally:
+            self.current_stage = previous_stage
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_start_time"].pop()
+        rows = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount > 0 else 0
+        rows_fetched, rows_written = 0, 0
+        if context is not None and (context.isinsert or context.isupdate or context.isdelete):
+            rows_written = len(parameters) if executemany else rows
+        else:
+            rows_fetched = rows
+        call_site = find_call_site()
+        with self.lock:
+            self.stages[self.current_stage].add(seconds, rows_fetched, rows_written)
+            self.call_sites[(self.current_stage, call_site)].add(seconds, rows_fetched, rows_written)
+
+    def report(self):
+        with self.lock:
+            return dict(
+                stages={stage: asdict(stat) for stage, stat in self.stages.items()},
+                call_sites=[
+                    dict(stage=stage, call_site=call_site, **asdict(stat))
+                    for (stage, call_site), stat in sorted(
+                        self.call_sites.items(), key=lambda item: -item[1].seconds
+                    )
+                ],
+            )
+
+    def format_report(self):
+        report = self.report()
+        rows = [(stage, stat) for stage, stat in report["stages"].items()]
+        rows.append(None)
+        rows.extend((f"{stat['stage']}: {stat['call_site']}", stat) for stat in report["call_sites"])
+        width = max([len("call site")] + [len(row[0]) for row in rows if row is not None]) + 2
+        header = f"{'queries':>9}{'seconds':>10}{'fetched':>10}{'written':>10}"
+        lines = [f"{'stage':<{width}}{header}"]
+        for row in rows:
+            if row is None:
+                lines.extend(["", f"{'call site':<{width}}{header}"])
+                continue
+            name, stat = row
+            lines.append(
+                f"{name:<{width}}{stat['queries']:>9}{stat['seconds']:>10.3f}"
+                f"{stat['rows_fetched']:>10}{stat['rows_written']:>10}"
+            )
+        return "\n".join(lines)
+
+
+profiler = QueryProfiler()
@@ -1,10 +1,36 @@
 import enum
+from decimal import Decimal
 
-from sqlalchemy import Column, Integer, BigInteger, String, Numeric, Enum, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Numeric, Enum, Boolean, DateTime, Index, inspect
+from sqlalchemy.types import TypeDecorator
 
 from .database import Base, engine
 
 
+class Amount(TypeDecorator):
+    """
+    Token amount in wei, NUMERIC(60, 0). SQLite would store it as a REAL and
+    round every amount above 2**53, so there it is stored as a decimal string.
+    """
+    impl = Numeric(precision=60, scale=0)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "sqlite":
+            return dialect.type_descriptor(String(80))
+        return dialect.type_descriptor(self.impl)
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != "sqlite":
+            return value
+        return str(int(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name != "sqlite":
+            return value
+        return Decimal(value)
+
+
 class DelegatorCreated(Base):
     __tablename__ = 'delegator_created'
     id = Column(String(100), unique=True, primary_key=True)
@@ -20,10 +46,10 @@ class Staked(Base):
     id = Column(String(100), unique=True, primary_key=True)
     delegator = Column(String(66))
     delegatee = Column(String(66))
-    amount = Column(Numeric(precision=60, scale=0))
+    amount = Column(Amount)
     blockNumber = Column(BigInteger)
     blockTimestamp = Column(Integer)
-    transactionHash = Column(String(66))
+    transactionHash = Column(String(66), index=True)
 
 
 class Withdrawn(Base):
@@ -31,10 +57,10 @@ class Withdrawn(Base):
     id = Column(String(100), unique=True, primary_key=True)
     delegator = Column(String(66))
     delegatee = Column(String(66))
-    amount = Column(Numeric(precision=60, scale=0))
+    amount = Column(Amount)
     blockNumber = Column(BigInteger)
     blockTimestamp = Column(Integer)
-    transactionHash = Column(String(66))
+    transactionHash = Column(String(66), index=True)
 
 
 class DelegateChanged(Base):
@@ -45,18 +71,18 @@ class DelegateChanged(Base):
     toDelegate = Column(String(66))
     blockNumber = Column(BigInteger)
     blockTimestamp = Column(Integer)
-    transactionHash = Column(String(66))
+    transactionHash = Column(String(66), index=True)
 
 
 class DelegateVotesChanged(Base):
     __tablename__ = 'delegate_votes_changed'
     id = Column(String(100), unique=True, primary_key=True)
     delegate = Column(String(66))
-    previousBalance = Column(Numeric(precision=60, scale=0))
-    newBalance = Column(Numeric(precision=60, scale=0))
+    previousBalance = Column(Amount)
+    newBalance = Column(Amount)
     blockNumber = Column(BigInteger)
     blockTimestamp = Column(Integer)
-    transactionHash = Column(String(66))
+    transactionHash = Column(String(66), index=True)
 
 
 class Transfer(Base):
@@ -64,19 +90,22 @@ class Transfer(Base):
     id = Column(String(100), unique=True, primary_key=True)
     from_ = Column(String(66))
     to = Column(String(66))
-    amount = Column(Numeric(precision=60, scale=0))
+    amount = Column(Amount)
     blockNumber = Column(BigInteger)
     blockTimestamp = Column(Integer)
-    transactionHash = Column(String(66))
+    transactionHash = Column(String(66), index=True)
 
 
 class VoteCast(Base):
     __tablename__ = 'vote_cast'
+    __table_args__ = (
+        Index('ix_vote_cast_proposal_voter', 'proposalId', 'voter'),
+    )
     id = Column(String(100), unique=True, primary_key=True)
     voter = Column(String(66))
     proposalId = Column(Integer)
     support = Column(Boolean)
-    votes = Column(Numeric(precision=60, scale=0))
+    votes = Column(Amount)
     blockNumber = Column(BigInteger)
     blockTimestamp = Column(Integer)
     transactionHash = Column(String(66))
@@ -104,13 +133,16 @@ class EventType(enum.Enum):
 
 class DelegationRecord(Base):
     __tablename__ = 'delegation_record'
+    __table_args__ = (
+        Index('ix_delegation_record_pair_block', 'delegator', 'delegatee', 'blockNumber'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     # user
     delegator = Column(String(66))
     # keeper
     delegatee = Column(String(66))
     event_type = Column(Enum(EventType))
-    balance = Column(Numeric(precision=60, scale=0))
+    balance = Column(Amount)
     blockNumber = Column(BigInteger)
     blockTimestamp = Column(Integer)
     transactionHash = Column(String(66))
@@ -118,15 +150,78 @@ class DelegationRecord(Base):
 
 class VoteStat(Base):
     __tablename__ = 'vote_stat'
+    __table_args__ = (
+        Index('ix_vote_stat_delegatee_proposal', 'delegatee', 'proposalId'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     # user
     delegator = Column(String(66))
     # keeper
     delegatee = Column(String(66))
     proposalId = Column(Integer)
-    balance = Column(Numeric(precision=60, scale=0))
+    balance = Column(Amount)
     no_of_days = Column(Integer)
 
 
+class BuildWatermark(Base):
+    __tablename__ = 'build_watermark'
+    # name of the derived table, e.g. delegation_record
+    name = Column(String(100), primary_key=True)
+    # last transaction processed into the table, in (blockNumber, transactionHash) order
+    blockNumber = Column(BigInteger)
+    transactionHash = Column(String(66))
+
+
+class FetchShard(Base):
+    __tablename__ = 'fetch_shard'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # graphql collection, e.g. transfers
+    table_key = Column(String(100))
+    # block range [start_block, end_block) fetched by this shard
+    start_block = Column(BigInteger)
+    end_block = Column(BigInteger)
+    # (blockNumber, id) of the last entity written, the shard resumes from here
+    cursor = Column(BigInteger)
+    cursor_id = Column(String(100))
+    completed = Column(Boolean, default=False)
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    # graphql collection, e.g. transfers
+    stream = Column(String(100), primary_key=True)
+    # (blockNumber, id) of the last entity written, the stream resumes from here
+    blockNumber = Column(BigInteger)
+    entity_id = Column(String(100))
+    # every entity up to this block is stored, set when a fetch of the stream completes
+    synced_block = Column(BigInteger)
+    updated_at = Column(DateTime)
+
+
 def create_db_models():
     Base.metadata.create_all(engine)
+
+
+def create_db_indexes():
+    """
+    Creates the indexes declared on the models on tables that already exist,
+    and recreates the ones whose columns changed. Returns the names of the
+    indexes that were (re)created.
+    """
+    inspector = inspect(engine)
+    created_indexes = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_indexes = {
+            index["name"]: index["column_names"] for index in inspector.get_indexes(table.name)
+        }
+        for index in table.indexes:
+            columns = [column.name for column in index.columns]
+            if existing_indexes.get(index.name) == columns:
+                continue
+            if index.name in existing_indexes:
+                index.drop(engine)
+            index.create(engine)
+            created_indexes.append(index.name)
+    return created_indexes
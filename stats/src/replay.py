@@ -0,0 +1,284 @@
+import glob
+import gzip
+import json
+import os
+import random
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .fetch_data import STREAMS
+from .graphql import create_http_session
+
+FIXTURE_SUFFIX = ".jsonl.gz"
+# alias: collection ( arguments ) { fields }
+SELECTION_PATTERN = re.compile(r"(?:(\w+)\s*:\s*)?(\w+)\s*\(([^()]*)\)\s*\{([^{}]*)\}")
+FILTER_PATTERN = re.compile(r'(\w+)\s*:\s*("[^"]*"|\[[^\]]*\])')
+OR_BRANCH_PATTERN = re.compile(r"\{([^{}]*)\}")
+FILTER_OPERATORS = ["_gte", "_gt", "_lte", "_lt", "_in", "_not"]
+
+
+def fixture_path(directory, table_key):
+    return os.path.join(directory, f"{table_key}{FIXTURE_SUFFIX}")
+
+
+class FixtureRecorder:
+    """
+    Appends every entity returned by the indexer to <table_key>.jsonl.gz.
+    Entities of overlapping pages are recorded twice and deduplicated on load.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def record(self, table_key, entities):
+        if not entities:
+            return
+        lines = "".join(json.dumps(entity) + "\n" for entity in entities)
+        with self.lock, gzip.open(fixture_path(self.directory, table_key), "at") as f:
+            f.write(lines)
+
+
+def load_fixtures(directory):
+    fixtures = {}
+    for path in glob.glob(os.path.join(directory, f"*{FIXTURE_SUFFIX}")):
+        table_key = os.path.basename(path)[:-len(FIXTURE_SUFFIX)]
+        with gzip.open(path, "rt") as f:
+            entities = {entity["id"]: entity for entity in map(json.loads, f)}
+        fixtures[table_key] = list(entities.values())
+    return fixtures
+
+
+def synthetic_fixtures(rows_per_stream, seed=1, start_block=13360297, addresses=1000):
+    """
+    Random entities for every stream, only meant for measuring ingestion:
+    the values are well formed but do not describe a consistent history.
+    """
+    rnd = random.Random(seed)
+    address_pool = ["0x" + f"{rnd.getrandbits(160):040x}" for _ in range(addresses)]
+    fixtures = {}
+    for table_key, stream in STREAMS.items():
+        block = start_block
+        entities = []
+        for i in range(rows_per_stream):
+            block += rnd.randint(0, 20)
+            transaction_hash = "0x" + f"{rnd.getrandbits(256):064x}"
+            values = {
+                "id": transaction_hash + f"{i % 256:08x}",
+                "blockNumber": str(block),
+                "blockTimestamp": str(1633453569 + (block - start_block) * 13),
+                "transactionHash": transaction_hash,
+                "proposalId": str(rnd.randint(1, 30)),
+                "support": rnd.random() < 0.9,
+            }
+            entity = {}
+            for field in stream["fields"]:
+                if field in values:
+                    entity[field] = values[field]
+                elif field in ("amount", "previousBalance", "newBalance", "votes"):
+                    entity[field] = str(rnd.randint(1, 10 ** 6) * 10 ** 15)
+                else:
+                    entity[field] = rnd.choice(address_pool)
+            entities.append(entity)
+        fixtures[table_key] = entities
+    return fixtures
+
+
+def parse_query(query):
+    """
+    Parses the queries built by GraphQueryHandler into a list of
+    (response key, collection, first, orderBy, filters, fields).
+    """
+    selections = []
+    for alias, collection, arguments, fields in SELECTION_PATTERN.findall(query):
+        first = re.search(r"first\s*:\s*(\d+)", arguments)
+        order_by = re.search(r"orderBy\s*:\s*(\w+)", arguments)
+        where = re.search(r"where\s*:\s*\{(.*)\}", arguments)
+        filters = parse_filters(where.group(1) if where else "")
+        selections.append((
+            alias or collection,
+            collection,
+            int(first.group(1)) if first else 100,
+            order_by.group(1) if order_by else "id",
+            filters,
+            fields.split(),
+        ))
+    return selections
+
+
+def parse_filters(where):
+    """
+    Filters of a where argument as (key, value) pairs; an or of several
+    filter objects becomes ("or", [filters, ...]).
+    """
+    branches = re.match(r"\s*or\s*:\s*\[(.*)\]\s*$", where)
+    if branches:
+        return [("or", [parse_filters(branch) for branch in OR_BRANCH_PATTERN.findall(branches.group(1))])]
+    return [(key, json.loads(value)) for key, value in FILTER_PATTERN.findall(where)]
+
+
+def split_filter(key):
+    for operator in FILTER_OPERATORS:
+        if key.endswith(operator):
+            return key[:-len(operator)], operator
+    return key, ""
+
+
+def comparable(value):
+    # BigInt fields are sent as decimal strings and compared as numbers
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+
+def matches(entity, filters):
+    for key, value in filters:
+        if key == "or":
+            if not any(matches(entity, branch) for branch in value):
+                return False
+            continue
+        field, operator = split_filter(key)
+        entity_value = comparable(entity[field])
+        if operator == "_in":
+            if entity_value not in [comparable(item) for item in value]:
+                return False
+            continue
+        value = comparable(value)
+        if operator == "" and not entity_value == value:
+            return False
+        if operator == "_not" and entity_value == value:
+            return False
+        if operator == "_gt" and not entity_value > value:
+            return False
+        if operator == "_gte" and not entity_value >= value:
+            return False
+        if operator == "_lt" and not entity_value < value:
+            return False
+        if operator == "_lte" and not entity_value <= value:
+            return False
+    return True
+
+
+class FixtureIndex:
+    """
+    Answers collection queries from a list of entities per collection, kept
+    sorted by (blockNumber, id) so block range pages are found by bisection.
+    Like a hosted indexer it can reject documents that request more than
+    max_complexity entities times fields.
+    """
+
+    def __init__(self, fixtures, max_complexity=None):
+        self.max_complexity = max_complexity
+        self.entities = {}
+        self.blocks = {}
+        for table_key, entities in fixtures.items():
+            entities = sorted(entities, key=lambda entity: (int(entity["blockNumber"]), entity["id"]))
+            self.entities[table_key] = entities
+            self.blocks[table_key] = [int(entity["blockNumber"]) for entity in entities]
+        self.head_block = max((blocks[-1] for blocks in self.blocks.values() if blocks), default=0)
+
+    def select(self, collection, first, order_by, filters):
+        entities, blocks = self.entities.get(collection, []), self.blocks.get(collection, [])
+        lower, upper = self.block_range(blocks, filters)
+        candidates = (entities[i] for i in range(lower, upper) if matches(entities[i], filters))
+        if order_by != "blockNumber":
+            # graph-node breaks ties in orderBy by id
+            candidates = iter(sorted(candidates, key=lambda entity: (comparable(entity[order_by]), entity["id"])))
+        results = []
+        for entity in candidates:
+            results.append(entity)
+            if len(results) == first:
+                break
+        return results
+
+    def block_range(self, blocks, filters):
+        lower, upper = 0, len(blocks)
+        for key, value in filters:
+            if key == "or":
+                # the union of the branch ranges
+                ranges = [self.block_range(blocks, branch) for branch in value]
+                lower = max(lower, min(branch_lower for branch_lower, _ in ranges))
+                upper = min(upper, max(branch_upper for _, branch_upper in ranges))
+                continue
+            field, operator = split_filter(key)
+            if field != "blockNumber" or operator not in ("", "_gt", "_gte", "_lt", "_lte"):
+                continue
+            if operator in ("", "_gte"):
+                lower = max(lower, bisect_left(blocks, int(value)))
+            if operator == "_gt":
+                lower = max(lower, bisect_right(blocks, int(value)))
+            if operator in ("", "_lte"):
+                upper = min(upper, bisect_right(blocks, int(value)))
+            if operator == "_lt":
+                upper = min(upper, bisect_left(blocks, int(value)))
+        return lower, upper
+
+    def answer(self, query):
+        if "_meta" in query and "(" not in query:
+            return {"data": {"_meta": {"block": {"number": self.head_block}}}}
+        selections = parse_query(query)
+        complexity = sum(first * len(fields) for _, _, first, _, _, fields in selections)
+        if self.max_complexity is not None and complexity > self.max_complexity:
+            return {"errors": [{
+                "message": f"query complexity {complexity} exceeds the maximum of {self.max_complexity}"
+            }]}
+        data = {}
+        for key, collection, first, order_by, filters, fields in selections:
+            data[key] = [
+                {field: entity[field] for field in fields}
+                for entity in self.select(collection, first, order_by, filters)
+            ]
+        return {"data": data}
+
+
+class StandInIndexerHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        query = json.loads(body)["query"]
+        if self.server.upstream_url is None:
+            status, response = 200, json.dumps(self.server.index.answer(query)).encode()
+        else:
+            upstream_response = self.server.http_session.post(self.server.upstream_url, data=body)
+            status, response = upstream_response.status_code, upstream_response.content
+            if upstream_response.ok:
+                self.server.record(query, upstream_response.json())
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInIndexer(ThreadingHTTPServer):
+    """
+    Local stand-in for the subgraph endpoint. It either answers queries from
+    fixtures, or forwards them to upstream_url and records the responses.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, fixtures=None, upstream_url=None, recorder=None, max_complexity=None):
+        super().__init__(address, StandInIndexerHandler)
+        self.index = FixtureIndex(fixtures or {}, max_complexity=max_complexity)
+        self.upstream_url = upstream_url
+        self.recorder = recorder
+        self.http_session = create_http_session() if upstream_url else None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, query, response):
+        if self.recorder is None or "data" not in response:
+            return
+        collections = {key: collection for key, collection, *_ in parse_query(query)}
+        for key, entities in response["data"].items():
+            if key in collections:
+                self.recorder.record(collections[key], entities)
@@ -0,0 +1,159 @@
+import glob
+import os
+from itertools import groupby
+
+from sqlalchemy import BigInteger, Boolean, Integer, String, insert, select
+
+from .config import SNAPSHOT_DIR, SNAPSHOT_PARTITION_BLOCKS
+from .database import Session, use_database
+from .export import import_pyarrow, iter_query_chunks
+from .models import (
+    Amount,
+    DelegateChanged,
+    DelegatorCreated,
+    DelegateVotesChanged,
+    Staked,
+    Transfer,
+    VoteCast,
+    Withdrawn,
+)
+
+SNAPSHOT_MODELS = [DelegatorCreated, Staked, Withdrawn, DelegateChanged, DelegateVotesChanged, Transfer, VoteCast]
+# the tables BuildAccountDelegation queries with SQL, the only ones loaded into a database
+SQL_SNAPSHOT_MODELS = [Staked, Withdrawn, DelegateChanged, DelegateVotesChanged, Transfer]
+SNAPSHOT_CHUNK_SIZE = 50_000
+
+
+def arrow_schema(pa, model):
+    arrow_types = {
+        Amount: pa.decimal256(60, 0),
+        BigInteger: pa.int64(),
+        Integer: pa.int64(),
+        String: pa.string(),
+        Boolean: pa.bool_(),
+    }
+    return pa.schema([
+        pa.field(column.name, arrow_types[type(column.type)]) for column in model.__table__.columns
+    ])
+
+
+def snapshot_partitions(table_dir):
+    # partitions are named after their first block, zero padded so they sort in block order
+    return sorted(glob.glob(os.path.join(table_dir, "*.parquet")))
+
+
+def partition_path(table_dir, partition_start):
+    return os.path.join(table_dir, f"{partition_start:012d}.parquet")
+
+
+class PartitionWriter:
+    """
+    Writes one block partition to a temporary file that replaces the previous
+    version of the partition only once it is complete.
+    """
+
+    def __init__(self, pq, path, schema):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.writer = pq.ParquetWriter(self.tmp_path, schema, compression="zstd")
+        self.rows = 0
+
+    def write(self, table):
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def write_snapshot(directory=SNAPSHOT_DIR, partition_blocks=SNAPSHOT_PARTITION_BLOCKS, full=False):
+    """
+    Writes the event tables to `directory`/<table>/<first block>.parquet, one
+    file per `partition_blocks` blocks. Only the last stored partition, which
+    may have been incomplete, and the partitions after it are (re)written
+    unless `full` is set. Returns (table name, partition path, rows) of every
+    partition written.
+    """
+    pa, pq = import_pyarrow("snapshots")
+    written = []
+    for model in SNAPSHOT_MODELS:
+        table_dir = os.path.join(directory, model.__tablename__)
+        os.makedirs(table_dir, exist_ok=True)
+        partitions = snapshot_partitions(table_dir)
+        from_block = 0
+        if partitions and not full:
+            from_block = int(os.path.basename(partitions[-1]).split(".")[0])
+
+        schema = arrow_schema(pa, model)
+        columns = model.__table__.columns
+        statement = select(*columns).where(model.blockNumber >= from_block).order_by(model.blockNumber, model.id)
+        block_index = columns.keys().index("blockNumber")
+        writer = None
+        with Session() as session:
+            for rows in iter_query_chunks(session, statement, SNAPSHOT_CHUNK_SIZE):
+                # rows come in block order, so every partition is written in one go
+                for partition_start, partition_rows in groupby(
+                        rows, key=lambda row: row[block_index] // partition_blocks * partition_blocks
+                ):
+                    partition_rows = list(partition_rows)
+                    path = partition_path(table_dir, partition_start)
+                    if writer is None or writer.path != path:
+                        if writer is not None:
+                            writer.close()
+                            written.append((model.__tablename__, writer.path, writer.rows))
+                        writer = PartitionWriter(pq, path, schema)
+                    writer.write(pa.Table.from_pylist(
+                        [row._asdict() for row in partition_rows], schema=schema
+                    ))
+        if writer is not None:
+            writer.close()
+            written.append((model.__tablename__, writer.path, writer.rows))
+    return written
+
+
+def load_snapshot(session, directory=SNAPSHOT_DIR):
+    """
+    Inserts every partition of the tables the delegation records are built
+    from into the tables of `session`. The parquet files are memory mapped and
+    read one record batch at a time.
+    """
+    pa, pq = import_pyarrow("snapshots")
+    for model in SQL_SNAPSHOT_MODELS:
+        for path in snapshot_partitions(os.path.join(directory, model.__tablename__)):
+            table = pq.read_table(path, memory_map=True)
+            for batch in table.to_batches(max_chunksize=SNAPSHOT_CHUNK_SIZE):
+                # executemany takes one dict per row
+                session.execute(insert(model), batch.to_pylist())
+    session.commit()
+
+
+def read_snapshot_table(model, directory=SNAPSHOT_DIR, columns=None):
+    """
+    Returns a snapshot table as a DataFrame, read from its memory mapped
+    partitions without going through a database.
+    """
+    pa, pq = import_pyarrow("snapshots")
+    schema = arrow_schema(pa, model)
+    if columns is not None:
+        schema = pa.schema([schema.field(column) for column in columns])
+    tables = [
+        pq.read_table(path, columns=schema.names, memory_map=True)
+        for path in snapshot_partitions(os.path.join(directory, model.__tablename__))
+    ]
+    return pa.concat_tables(tables or [schema.empty_table()]).to_pandas()
+
+
+def use_snapshot(database_path, directory=SNAPSHOT_DIR):
+    """
+    Points Session at a new SQLite database file at database_path, loaded with
+    the tables the delegation records are built from. Being a file, it can be
+    opened by worker processes too. The pandas based stages read the vote
+    casts from the snapshot itself, see read_snapshot_table.
+    """
+    if not os.path.isdir(directory):
+        raise Exception(f"no snapshot found in {directory}, run snapshot-data first")
+    snapshot_engine = use_database(f"sqlite:///{database_path}")
+    with Session() as session:
+        load_snapshot(session, directory)
+    return snapshot_engine
@@ -1,14 +1,21 @@
 import datetime
+import math
+import os
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass
 from decimal import Decimal
+from fractions import Fraction
 
+import numpy as np
 import pandas as pd
-from eth_utils.address import to_checksum_address
-from eth_utils.currency import from_wei
-from sqlalchemy import and_, func
+from sqlalchemy import and_, create_engine, func, insert, or_, select
+from sqlalchemy.orm import sessionmaker
 
 from .database import Session
+from .export import StreamingExport, iter_query_chunks
+from .fetch_data import TARGETED_TRANSFERS_KEY
 from .models import (
     DelegateChanged,
     DelegateVotesChanged,
@@ -16,10 +23,13 @@ from .models import (
     Transfer,
     Withdrawn,
     DelegationRecord,
+    BuildWatermark,
     EventType,
+    SyncState,
     VoteCast,
     VoteStat,
 )
+from .utils import checksum_addresses, wei_to_ether
 
 
 class DataExists:
@@ -36,6 +46,44 @@ class EventData:
     withdrawn: Withdrawn
 
 
+@dataclass
+class BalanceChange:
+    """
+    A delegation record to write. Its balance is `balance` when given, else the
+    latest balance of (balance_of or delegator, delegatee) plus `delta`. When
+    that latest balance is zero and `otherwise` is set, `otherwise` is written
+    instead.
+    """
+    delegator: str
+    delegatee: str
+    delta: Decimal = None
+    balance: Decimal = None
+    balance_of: str = None
+    otherwise: 'BalanceChange' = None
+
+
+def worker_database_url(session, task):
+    """
+    Returns the URL worker processes connect to the database of session with.
+    An in-memory SQLite database only exists in the parent's connection.
+    """
+    database_url = session.get_bind().url
+    if database_url.get_backend_name() == "sqlite" and database_url.database in (None, "", ":memory:"):
+        raise Exception(f"{task} can only be done by several workers from a database file or server")
+    return database_url.render_as_string(hide_password=False)
+
+
+@contextmanager
+def worker_session(database_url):
+    # runs in a worker process, which must not share the parent's connections
+    engine = create_engine(database_url)
+    try:
+        with sessionmaker(bind=engine)() as session:
+            yield session
+    finally:
+        engine.dispose()
+
+
 class DelegatesChangedData(DataExists):
     ...
 
@@ -107,108 +155,133 @@ START_BLOCK = 13360297
 START_DATETIME = convert_epoch_to_datetime(1633453569)
 END_BLOCK_TIMESTAMP = 1703980800
 
+# number of delegation records written to the database at once
+RECORD_FLUSH_SIZE = 10_000
+# same order as the fields of EventData
+EVENT_MODELS = [DelegateChanged, DelegateVotesChanged, Staked, Transfer, Withdrawn]
+# sync_state keys of the streams of EVENT_MODELS; transfers are stored by either transfer mode
+SYNCED_STREAMS = [
+    ["delegateChangeds"], ["delegateVotesChangeds"], ["stakeds"], ["transfers", TARGETED_TRANSFERS_KEY], ["withdrawns"],
+]
+
+
 class BuildAccountDelegation:
 
-    def build(self):
+    def __init__(self, flush_size=RECORD_FLUSH_SIZE):
+        # latest balance per (delegator, delegatee)
+        self.balances = dict()
+        self.pending_records = list()
+        self.flush_size = flush_size
+        # (blockNumber, transactionHash) of the last transaction processed
+        self.watermark = None
+
+    def build(self, rebuild=False, workers=1):
         with Session() as session:
-            subquery = session.query(
-                DelegateVotesChanged.blockNumber,
-                DelegateVotesChanged.transactionHash,
-                DelegateVotesChanged.blockTimestamp,
-            ).distinct(DelegateVotesChanged.transactionHash).subquery()
-            for delegate_vote_changed in session.query(
-                    subquery.c.transactionHash, subquery.c.blockNumber, subquery.c.blockTimestamp
-            ).order_by(subquery.c.blockNumber).all():
-                event_type, data = self.classify_event_type(
-                    session,
-                    delegate_vote_changed.transactionHash
+            if rebuild:
+                self.reset(session)
+            self.load_state(session)
+            synced_block = self.get_synced_block(session)
+            transactions = self.fetch_transactions(session, self.watermark, synced_block)
+            if workers > 1:
+                classified = self.classify_in_parallel(session, transactions, workers)
+            else:
+                from_block = self.watermark[0] if self.watermark else 0
+                classified = self.classify_transactions(
+                    transactions, self.group_events_by_transaction(session, from_block, synced_block)
                 )
-                self.write_record(
-                    session,
-                    delegate_vote_changed.transactionHash,
-                    delegate_vote_changed.blockNumber,
-                    delegate_vote_changed.blockTimestamp,
-                    event_type,
-                    data
+            # balances depend on every earlier transaction, so the changes are
+            # always applied here, one transaction at a time in block order
+            for (tx_hash, block_number, block_timestamp), event_type, changes in classified:
+                for change in changes:
+                    self.apply_change(change, tx_hash, block_number, block_timestamp, event_type)
+                self.watermark = (block_number, tx_hash)
+                if len(self.pending_records) >= self.flush_size:
+                    self.flush_records(session)
+            self.flush_records(session)
+
+    def classify_in_parallel(self, session, transactions, workers):
+        """
+        Classifying a transaction only needs its own events, so the
+        transactions are split into consecutive batches of flush_size that
+        worker processes load and classify with their own database connection.
+        executor.map yields the batches in submission order, i.e. block order.
+        """
+        database_url = worker_database_url(session, "classifying transactions")
+        batches = [
+            [tuple(transaction) for transaction in transactions[i:i + self.flush_size]]
+            for i in range(0, len(transactions), self.flush_size)
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for classified in executor.map(classify_transaction_batch, [database_url] * len(batches), batches):
+                yield from classified
+
+    @classmethod
+    def classify_transactions(cls, transactions, grouped_events):
+        """
+        Yields ((transactionHash, blockNumber, blockTimestamp), event type,
+        balance changes) for every transaction, in the given order.
+        """
+        delegate_changed, delegate_votes_changed, staked, transfer, withdrawn = grouped_events
+        for tx_hash, block_number, block_timestamp in transactions:
+            event_type, data = cls.classify_events(
+                EventData(
+                    delegate_changed=delegate_changed.get(tx_hash, []),
+                    delegate_votes_changed=delegate_votes_changed.get(tx_hash, []),
+                    staked=staked.get(tx_hash, []),
+                    transfer=transfer.get(tx_hash, []),
+                    withdrawn=withdrawn.get(tx_hash, []),
                 )
+            )
+            yield (tx_hash, block_number, block_timestamp), event_type, cls.plan_changes(event_type, data)
 
-    def write_record(self, session, tx_hash, block_number, block_timestamp, event_type, data):
+    def write_record(self, tx_hash, block_number, block_timestamp, event_type, data):
+        for change in self.plan_changes(event_type, data):
+            self.apply_change(change, tx_hash, block_number, block_timestamp, event_type)
+
+    @classmethod
+    def plan_changes(cls, event_type, data):
+        """
+        Returns the balance changes of a classified transaction in the order
+        their records are written. This only looks at the events of the
+        transaction, the balances are resolved by apply_change.
+        """
         if event_type == EventType.DIRECT_DELEGATION:
             if len(data.delegate_changed) == 1 and len(data.delegate_votes_changed) == 1:
                 # 0x9c7118eb0c347a84f1411060c580ee1fe354de4bc82f885ffea7e53970c5bf27
-                latest_balance = self.get_latest_balance(
-                    session,
-                    data.delegate_changed[0].delegator,
-                    data.delegate_changed[0].toDelegate
-                )
-                record = DelegationRecord(
+                return [BalanceChange(
                     delegator=data.delegate_changed[0].delegator,
                     delegatee=data.delegate_changed[0].toDelegate,
-                    balance=latest_balance + data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[
-                        0].previousBalance,
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record)
+                    delta=data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[0].previousBalance,
+                )]
             elif len(data.delegate_changed) == 1 and len(data.delegate_votes_changed) == 2 and \
                     data.delegate_votes_changed[0].newBalance == 0:
                 # delegator changed; old delegator balance becomes 0, new one gets 1st event previousBalance.
                 # Also for the 2nd event newBalance - oldBalance = previousBalance of 1st event
                 # 0x0dc8bca57fbf2d4c283a1130e29d51c927a7cb93c0dcc297b157ea4936fe0fd3
-                latest_balance2 = self.get_latest_balance(
-                    session,
-                    data.delegate_changed[0].delegator,
-                    data.delegate_changed[0].fromDelegate
-                )
-                record1 = DelegationRecord(
-                    delegator=data.delegate_changed[0].delegator,
-                    delegatee=data.delegate_changed[0].fromDelegate,
-                    balance=latest_balance2 + (data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[
-                        0].previousBalance),
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                latest_balance2 = self.get_latest_balance(
-                    session,
-                    data.delegate_changed[0].delegator,
-                    data.delegate_changed[0].toDelegate
-                )
-                record2 = DelegationRecord(
-                    delegator=data.delegate_changed[0].delegator,
-                    delegatee=data.delegate_changed[0].toDelegate,
-                    balance=latest_balance2 + (data.delegate_votes_changed[1].newBalance - data.delegate_votes_changed[
-                        1].previousBalance),
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record1)
-                session.add(record2)
+                return [
+                    BalanceChange(
+                        delegator=data.delegate_changed[0].delegator,
+                        delegatee=data.delegate_changed[0].fromDelegate,
+                        delta=data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[
+                            0].previousBalance,
+                    ),
+                    BalanceChange(
+                        delegator=data.delegate_changed[0].delegator,
+                        delegatee=data.delegate_changed[0].toDelegate,
+                        delta=data.delegate_votes_changed[1].newBalance - data.delegate_votes_changed[
+                            1].previousBalance,
+                    ),
+                ]
             else:
                 raise Exception('Unknown type')
         elif event_type == EventType.STAKED:
             if len(data.staked) == 1 and len(data.delegate_votes_changed) == 1:
                 # 0xe6d954dc98bf0dcda580463aa1a01ba773943f2480c2780a596cf565622361e1
-                latest_balance = self.get_latest_balance(
-                    session,
-                    data.staked[0].delegatee,
-                    data.delegate_votes_changed[0].delegate
-                )
-                record = DelegationRecord(
+                return [BalanceChange(
                     delegator=data.staked[0].delegatee,
                     delegatee=data.delegate_votes_changed[0].delegate,
-                    balance=latest_balance + data.staked[0].amount,
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record)
+                    delta=data.staked[0].amount,
+                )]
             elif (
                     len(data.staked) == 1 and
                     len(data.delegate_votes_changed) == 2 and
@@ -220,73 +293,36 @@ class BuildAccountDelegation:
             ):
                 # 0x0e12001d49195017c6090c5f3ea874e4dabfaa93f8f5081ebc1f5b2a69ff9f2f
                 # need to update records of two keepers
-                record1 = DelegationRecord(
-                    delegator=data.staked[0].delegatee,
-                    delegatee=data.delegate_votes_changed[0].delegate,
-                    balance=data.delegate_votes_changed[0].newBalance,
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                # make sure its committed as this might affect the latest balance
-                # when delegatee for both records is the same
-                session.add(record1)
-                session.commit()
-                latest_balance = self.get_latest_balance(
-                    session,
-                    data.staked[0].delegatee,
-                    data.delegate_votes_changed[1].delegate
-                )
-                record2 = DelegationRecord(
-                    delegator=data.staked[0].delegatee,
-                    delegatee=data.delegate_votes_changed[1].delegate,
-                    balance=latest_balance + data.staked[0].amount,
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record2)
+                return [
+                    BalanceChange(
+                        delegator=data.staked[0].delegatee,
+                        delegatee=data.delegate_votes_changed[0].delegate,
+                        balance=data.delegate_votes_changed[0].newBalance,
+                    ),
+                    BalanceChange(
+                        delegator=data.staked[0].delegatee,
+                        delegatee=data.delegate_votes_changed[1].delegate,
+                        delta=data.staked[0].amount,
+                    ),
+                ]
             else:
                 raise Exception('Unknown type')
         elif event_type == EventType.CTX_TRANSFER:
             if len(data.transfer) == 1 and len(data.delegate_votes_changed) == 1:
+                # sender has a balance with the delegate:
                 # 0xeab6d157a81eaf7bab8682adf130a6136b566bc686f07fe7da213e54bab3a210
+                # otherwise it's the receiver:
                 # 0xfb6353f0be46485e28702ee903b59251f1d7fe81b0afdef707244f773fa54a02
-                transfer_from = self.get_latest_balance(
-                    session,
-                    data.transfer[0].from_,
-                    data.delegate_votes_changed[0].delegate
-                )
-                transfer_to = self.get_latest_balance(
-                    session,
-                    data.transfer[0].to,
-                    data.delegate_votes_changed[0].delegate
-                )
-                if transfer_from:
-                    # 0xeab6d157a81eaf7bab8682adf130a6136b566bc686f07fe7da213e54bab3a210
-                    record = DelegationRecord(
-                        delegator=data.transfer[0].from_,
-                        delegatee=data.delegate_votes_changed[0].delegate,
-                        balance=transfer_from - data.transfer[0].amount,
-                        event_type=event_type,
-                        blockNumber=block_number,
-                        blockTimestamp=block_timestamp,
-                        transactionHash=tx_hash
-                    )
-                else:
-                    # 0xfb6353f0be46485e28702ee903b59251f1d7fe81b0afdef707244f773fa54a02
-                    record = DelegationRecord(
+                return [BalanceChange(
+                    delegator=data.transfer[0].from_,
+                    delegatee=data.delegate_votes_changed[0].delegate,
+                    delta=-data.transfer[0].amount,
+                    otherwise=BalanceChange(
                         delegator=data.transfer[0].to,
                         delegatee=data.delegate_votes_changed[0].delegate,
-                        balance=transfer_to + data.transfer[0].amount,
-                        event_type=event_type,
-                        blockNumber=block_number,
-                        blockTimestamp=block_timestamp,
-                        transactionHash=tx_hash
-                    )
-                session.add(record)
+                        delta=data.transfer[0].amount,
+                    ),
+                )]
             elif (
                     len(data.transfer) > 1 and
                     len(data.delegate_votes_changed) == 1 and
@@ -303,21 +339,11 @@ class BuildAccountDelegation:
                 # 0x4e6960173537b3b8c4ecb1aeafd6680b2d0146e5169de70fc277cc24948644ad
                 # delegatee = data.transfer[2].to
                 # delegate = data.delegate_votes_changed[0].delegate
-                latest_balance = self.get_latest_balance(
-                    session,
-                    data.transfer[-1].to,
-                    data.delegate_votes_changed[0].delegate
-                )
-                record = DelegationRecord(
+                return [BalanceChange(
                     delegator=data.transfer[-1].to,
                     delegatee=data.delegate_votes_changed[0].delegate,
-                    balance=latest_balance + data.transfer[-1].amount,
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record)
+                    delta=data.transfer[-1].amount,
+                )]
             elif (
                     len(data.transfer) > 1 and
                     len(data.delegate_votes_changed) == 1 and
@@ -328,35 +354,23 @@ class BuildAccountDelegation:
                 # exchange sell
                 # 0x300666908ec0581ef83e5f535734e6714aff5e46eb908511be773fd3466b310b
                 # 0xadec3a0a4a5de690f90b9cd608948a748cafd6f8710d6e70a3601e22cd0f2c9e
-                latest_balance = self.get_latest_balance(
-                    session,
-                    data.transfer[0].from_,
-                    data.delegate_votes_changed[0].delegate
-                )
-                record = DelegationRecord(
+                return [BalanceChange(
                     delegator=data.transfer[0].from_,
                     delegatee=data.delegate_votes_changed[0].delegate,
-                    balance=latest_balance - data.transfer[0].amount,
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record)
+                    delta=-data.transfer[0].amount,
+                )]
             elif all([
-                self.check_if_team_multisig(obj.delegate) for obj in data.delegate_votes_changed
+                cls.check_if_team_multisig(obj.delegate) for obj in data.delegate_votes_changed
             ]):
                 # cryptex team multisig distribution
                 # 0x32e6249c2425b3b9eee65f0a749708db6ae23f66e7b7cc036d4b25f1101f596e
-                pass
-            elif any([self.check_if_team_multisig(obj.delegate) for obj in data.delegate_votes_changed]):
+                return []
+            elif any([cls.check_if_team_multisig(obj.delegate) for obj in data.delegate_votes_changed]):
                 # cryptex team multisig distribution
                 delegations = [obj for obj in data.delegate_votes_changed if
-                               not self.check_if_team_multisig(obj.delegate)]
-                amounts = [obj.amount for obj in data.transfer]
+                               not cls.check_if_team_multisig(obj.delegate)]
+                changes = []
                 for _delegate_votes_changed in delegations:
-                    if self.check_if_team_multisig(_delegate_votes_changed.delegate):
-                        continue
                     for _transfer in data.transfer:
                         # 0x67e594578941b0bc7e2d1e654d554ac672a307667adcacc11137c5a2067453ce
                         # 0x04cb7a6842b3398a0a964df8854f04a8de3309940a97735f1392dd3edd3a8e21
@@ -365,22 +379,11 @@ class BuildAccountDelegation:
                                 _delegate_votes_changed.delegate == '0xb8c30017b375bf675c2836c4c6b6ed5be214739d'
                         # ugly but only special case
                         ):
-                            latest_balance = self.get_latest_balance(
-                                session,
-                                _transfer.to,
-                                _delegate_votes_changed.delegate
-                            )
-                            record = DelegationRecord(
+                            changes.append(BalanceChange(
                                 delegator=_transfer.to,
                                 delegatee=_delegate_votes_changed.delegate,
-                                balance=latest_balance + _transfer.amount,
-                                event_type=event_type,
-                                blockNumber=block_number,
-                                blockTimestamp=block_timestamp,
-                                transactionHash=tx_hash
-                            )
-                            session.add(record)
-                            session.commit()
+                                delta=_transfer.amount,
+                            ))
                             break
                     else:
                         for _transfer in data.transfer:
@@ -389,46 +392,26 @@ class BuildAccountDelegation:
                                     _delegate_votes_changed.newBalance - _delegate_votes_changed.previousBalance
                             ) == _transfer.amount
                             ):
-                                latest_balance = self.get_latest_balance(
-                                    session,
-                                    _transfer.to,
-                                    _delegate_votes_changed.delegate
-                                )
-                                record = DelegationRecord(
+                                changes.append(BalanceChange(
                                     delegator=_transfer.to,
                                     delegatee=_delegate_votes_changed.delegate,
-                                    balance=latest_balance + _transfer.amount,
-                                    event_type=event_type,
-                                    blockNumber=block_number,
-                                    blockTimestamp=block_timestamp,
-                                    transactionHash=tx_hash
-                                )
-                                session.add(record)
-                                session.commit()
+                                    delta=_transfer.amount,
+                                ))
                                 break
                         else:
                             raise Exception('Unknown type')
+                return changes
             else:
                 raise Exception('Unknown type')
         elif event_type == EventType.WITHDRAWN:
             if len(data.withdrawn) == 1 and len(data.delegate_votes_changed) == 1:
                 # 0x557200d874e5e6e5ce8b7a2aa23b4d72cf0d05b8ad2691d234480700da3d49a9
-                latest_balance = self.get_latest_balance(
-                    session,
-                    data.transfer[0].to,
-                    data.delegate_votes_changed[0].delegate
-                )
-                record = DelegationRecord(
+                return [BalanceChange(
                     delegator=data.withdrawn[0].delegatee,
                     delegatee=data.delegate_votes_changed[0].delegate,
-                    balance=latest_balance + (data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[
-                        0].previousBalance),
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record)
+                    delta=data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[0].previousBalance,
+                    balance_of=data.transfer[0].to,
+                )]
             elif (
                     len(data.withdrawn) == 1 and
                     len(data.delegate_votes_changed) == 2 and
@@ -439,61 +422,158 @@ class BuildAccountDelegation:
                     )
             ):
                 # 0xe95e3675994188e944ecda0ec3865bb4a9b8326f9ec2acfac19d6bdf87c6c4fd
-                latest_balance1 = self.get_latest_balance(
-                    session,
-                    data.transfer[0].to,
-                    data.delegate_votes_changed[0].delegate
-                )
-                record1 = DelegationRecord(
-                    delegator=data.transfer[0].to,
-                    delegatee=data.delegate_votes_changed[0].delegate,
-                    balance=latest_balance1 + (data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[
-                        0].previousBalance),
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record1)
-                session.commit()
-                latest_balance2 = self.get_latest_balance(
-                    session,
-                    data.withdrawn[0].delegatee,
-                    data.delegate_votes_changed[1].delegate
-                )
-                record2 = DelegationRecord(
-                    delegator=data.withdrawn[0].delegatee,
-                    delegatee=data.delegate_votes_changed[1].delegate,
-                    balance=latest_balance2 + (data.delegate_votes_changed[1].newBalance - data.delegate_votes_changed[
-                        1].previousBalance),
-                    event_type=event_type,
-                    blockNumber=block_number,
-                    blockTimestamp=block_timestamp,
-                    transactionHash=tx_hash
-                )
-                session.add(record2)
+                return [
+                    BalanceChange(
+                        delegator=data.transfer[0].to,
+                        delegatee=data.delegate_votes_changed[0].delegate,
+                        delta=data.delegate_votes_changed[0].newBalance - data.delegate_votes_changed[
+                            0].previousBalance,
+                    ),
+                    BalanceChange(
+                        delegator=data.withdrawn[0].delegatee,
+                        delegatee=data.delegate_votes_changed[1].delegate,
+                        delta=data.delegate_votes_changed[1].newBalance - data.delegate_votes_changed[
+                            1].previousBalance,
+                    ),
+                ]
             else:
                 raise Exception('Unknown type')
         else:
             raise Exception('Unknown type')
-        session.commit()
+
+    def apply_change(self, change, tx_hash, block_number, block_timestamp, event_type):
+        latest_balance = self.get_latest_balance(change.balance_of or change.delegator, change.delegatee)
+        if change.otherwise is not None and not latest_balance:
+            self.apply_change(change.otherwise, tx_hash, block_number, block_timestamp, event_type)
+            return
+        self.add_record(dict(
+            delegator=change.delegator,
+            delegatee=change.delegatee,
+            balance=change.balance if change.balance is not None else latest_balance + change.delta,
+            event_type=event_type,
+            blockNumber=block_number,
+            blockTimestamp=block_timestamp,
+            transactionHash=tx_hash
+        ))
 
     @staticmethod
     def check_if_team_multisig(address):
         return address == CRYPTEX_TEAM_MULTISIG_ADDRESS
 
+    def get_latest_balance(self, delegator, delegatee) -> Decimal:
+        return self.balances.get((delegator, delegatee), Decimal("0"))
+
+    def add_record(self, record):
+        # the ledger is updated as soon as a record is emitted, so later lookups in
+        # the same transaction see it without a round trip to the database.
+        self.balances[(record["delegator"], record["delegatee"])] = record["balance"]
+        self.pending_records.append(record)
+
+    def flush_records(self, session):
+        # row dicts in one executemany, ORM instances would be inserted one by one on some dialects
+        if self.pending_records:
+            session.execute(insert(DelegationRecord), self.pending_records)
+        if self.watermark is not None:
+            block_number, tx_hash = self.watermark
+            session.merge(BuildWatermark(
+                name=DelegationRecord.__tablename__,
+                blockNumber=block_number,
+                transactionHash=tx_hash,
+            ))
+        session.commit()
+        self.pending_records = []
+
     @staticmethod
-    def get_latest_balance(session, delegator, delegatee) -> Decimal:
-        old_record = session.query(DelegationRecord).filter(
-            and_(
-                DelegationRecord.delegator == delegator,
-                DelegationRecord.delegatee == delegatee
-            ),
-        ).order_by(DelegationRecord.blockNumber.desc()).first()
-        if old_record:
-            return old_record.balance
-        else:
-            return Decimal("0")
+    def reset(session):
+        session.query(DelegationRecord).delete()
+        session.query(BuildWatermark).filter(BuildWatermark.name == DelegationRecord.__tablename__).delete()
+        session.commit()
+
+    def load_state(self, session):
+        """
+        Seeds the ledger with the latest balance of every pair and the watermark
+        of the previous build, so that only newer transactions are processed.
+        """
+        latest_record_ids = session.query(func.max(DelegationRecord.id)).group_by(
+            DelegationRecord.delegator, DelegationRecord.delegatee
+        )
+        for delegator, delegatee, balance in session.query(
+                DelegationRecord.delegator, DelegationRecord.delegatee, DelegationRecord.balance
+        ).filter(DelegationRecord.id.in_(latest_record_ids)):
+            self.balances[(delegator, delegatee)] = balance
+
+        watermark = session.get(BuildWatermark, DelegationRecord.__tablename__)
+        if watermark is None:
+            # records built before watermarks existed; everything up to the last record is done
+            watermark = session.query(DelegationRecord).order_by(DelegationRecord.id.desc()).first()
+        if watermark is not None:
+            self.watermark = (watermark.blockNumber, watermark.transactionHash)
+
+    @staticmethod
+    def get_synced_block(session):
+        """
+        Returns the last block all the event streams of a transaction are
+        stored up to, or None without sync_state rows, e.g. for a snapshot.
+        The streams are fetched concurrently and each one stops at its own
+        head, so a transaction's DelegateVotesChanged can be stored before its
+        other events; such transactions are left for the next build.
+        """
+        synced_blocks = dict()
+        for state in session.query(SyncState):
+            # a stream that never completed a fetch may miss some entities of its last block
+            synced_blocks[state.stream] = (
+                state.synced_block if state.synced_block is not None else state.blockNumber - 1
+            )
+        stream_blocks = []
+        for table_keys in SYNCED_STREAMS:
+            blocks = [synced_blocks[table_key] for table_key in table_keys if table_key in synced_blocks]
+            if blocks:
+                stream_blocks.append(max(blocks))
+        return min(stream_blocks, default=None)
+
+    @staticmethod
+    def fetch_transactions(session, watermark=None, to_block=None):
+        subquery = session.query(
+            DelegateVotesChanged.blockNumber,
+            DelegateVotesChanged.transactionHash,
+            DelegateVotesChanged.blockTimestamp,
+        ).distinct(DelegateVotesChanged.transactionHash).subquery()
+        query = session.query(subquery.c.transactionHash, subquery.c.blockNumber, subquery.c.blockTimestamp)
+        if watermark is not None:
+            block_number, tx_hash = watermark
+            query = query.filter(or_(
+                subquery.c.blockNumber > block_number,
+                and_(subquery.c.blockNumber == block_number, subquery.c.transactionHash > tx_hash)
+            ))
+        if to_block is not None:
+            query = query.filter(subquery.c.blockNumber <= to_block)
+        return query.order_by(subquery.c.blockNumber, subquery.c.transactionHash).all()
+
+    @staticmethod
+    def group_events_by_transaction(session, from_block=0, to_block=None):
+        """
+        Loads the events of every transaction that has a DelegateVotesChanged
+        event with one query per event table, and groups them by transaction
+        hash in log order. Plain rows are used instead of ORM instances so that
+        the commits in flush_records don't expire them.
+        """
+        tx_hashes = select(DelegateVotesChanged.transactionHash).filter(
+            DelegateVotesChanged.blockNumber >= from_block
+        )
+        if to_block is not None:
+            tx_hashes = tx_hashes.filter(DelegateVotesChanged.blockNumber <= to_block)
+        tx_hashes = tx_hashes.distinct()
+        grouped_events = []
+        for model in EVENT_MODELS:
+            events = defaultdict(list)
+            for event in session.execute(
+                    select(*model.__table__.c).filter(
+                        model.transactionHash.in_(tx_hashes)
+                    ).order_by(model.blockNumber, model.id)
+            ):
+                events[event.transactionHash].append(event)
+            grouped_events.append(events)
+        return grouped_events
 
     @staticmethod
     def classify_event_type(session, tx_hash):
@@ -519,7 +599,18 @@ class BuildAccountDelegation:
             transfer=transfer,
             withdrawn=withdrawn
         )
-        data = [delegate_changed, delegate_votes_changed, staked, transfer, withdrawn]
+        return BuildAccountDelegation.classify_events(event_data)
+
+    @staticmethod
+    def classify_events(event_data):
+        delegate_votes_changed = event_data.delegate_votes_changed
+        data = [
+            event_data.delegate_changed,
+            delegate_votes_changed,
+            event_data.staked,
+            event_data.transfer,
+            event_data.withdrawn,
+        ]
         data_exists_list = [bool(obj) for obj in data]
         # any([len(obj) > 1 for obj in [delegate_changed, staked, transfer, withdrawn]]) or
         if len(delegate_votes_changed) > 2 and not delegate_votes_changed[
@@ -538,6 +629,14 @@ class BuildAccountDelegation:
             raise Exception('Unknown type')
 
 
+def classify_transaction_batch(database_url, transactions):
+    with worker_session(database_url) as session:
+        grouped_events = BuildAccountDelegation.group_events_by_transaction(
+            session, transactions[0][1], transactions[-1][1]
+        )
+        return list(BuildAccountDelegation.classify_transactions(transactions, grouped_events))
+
+
 def get_keeper_votes_on_proposals():
     with Session() as session:
         return session.query(VoteCast.voter, func.count(VoteCast.voter)).group_by(VoteCast.voter).order_by(
@@ -546,8 +645,29 @@ def get_keeper_votes_on_proposals():
 
 class VoteStatBuilder:
 
-    def build(self):
+    def __init__(self, vote_casts=None):
+        # vote_cast rows as a DataFrame, e.g. read from a snapshot, else read from the database once
+        self.vote_casts = vote_casts
+
+    def get_vote_casts(self, session):
+        if self.vote_casts is None:
+            self.vote_casts = read_vote_casts(session)
+        return self.vote_casts
+
+    def build(self, batched=True, workers=1):
         with Session() as session:
+            # vote stats are recomputed from scratch on every run
+            session.query(VoteStat).delete()
+            if batched and workers > 1:
+                session.commit()
+                self.build_in_parallel(session, workers)
+                return
+            if batched:
+                vote_stats = self.compute_vote_stats(session)
+                if vote_stats:
+                    session.execute(insert(VoteStat), vote_stats)
+                session.commit()
+                return
             for delegator, delegatee in self.fetch_delegator_delegatee_pair(session):
                 for proposal_id, in self.fetch_all_proposals_id(session):
                     vote_cast = self.fetch_delegate_voted_on_proposal(session, proposal_id, delegatee)
@@ -557,6 +677,116 @@ class VoteStatBuilder:
                         self.check_days_staked_and_create_record(session, proposal_id, delegator, delegatee, vote_cast)
             session.commit()
 
+    def build_in_parallel(self, session, workers):
+        """
+        The vote stats of a delegatee only depend on its own delegation records
+        and votes, so the delegatees are split into `workers` partitions of
+        about the same number of records, each computed and written by its own
+        process with its own database connection. vote_stat is always read in
+        VOTE_STAT_ORDER, so the result doesn't depend on the number of workers.
+        """
+        database_url = worker_database_url(session, "building vote stats")
+        record_counts = session.query(DelegationRecord.delegatee, func.count(DelegationRecord.id)).group_by(
+            DelegationRecord.delegatee
+        ).order_by(func.count(DelegationRecord.id).desc(), DelegationRecord.delegatee).all()
+        partitions = [[] for _ in range(workers)]
+        partition_sizes = [0] * workers
+        for delegatee, record_count in record_counts:
+            smallest = partition_sizes.index(min(partition_sizes))
+            partitions[smallest].append(delegatee)
+            partition_sizes[smallest] += record_count
+
+        vote_casts = self.get_vote_casts(session)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(build_vote_stat_partition, database_url, partition, vote_casts)
+                for partition in partitions if partition
+            ]
+            for future in as_completed(futures):
+                future.result()
+
+    def compute_vote_stats(self, session, delegatees=None):
+        """
+        Same result as calling check_days_staked_and_create_record for every
+        (delegator, delegatee) pair and proposal, computed from one read of
+        delegation_record and vote_cast. The three range queries of
+        calculate_no_days_staked_before_vote become merge_asof lookups on
+        records sorted by block:
+            latest zero balance:  last zero record in [START_BLOCK, vote block)
+            nearest entry:        first record after the zero record (or START_BLOCK)
+            latest non zero:      last positive record before the vote block
+        Only the records and votes of `delegatees` are used when it is given.
+        """
+        record_query = select(
+            DelegationRecord.id,
+            DelegationRecord.delegator,
+            DelegationRecord.delegatee,
+            DelegationRecord.balance,
+            DelegationRecord.blockNumber,
+            DelegationRecord.blockTimestamp,
+        )
+        if delegatees is not None:
+            record_query = record_query.where(DelegationRecord.delegatee.in_(delegatees))
+        records = pd.DataFrame(
+            session.execute(record_query).all(),
+            columns=['id', 'delegator', 'delegatee', 'balance', 'blockNumber', 'blockTimestamp'],
+        ).sort_values(['blockNumber', 'id'])
+        vote_casts = self.get_vote_casts(session)
+        # the proposals of fetch_all_proposals_id
+        proposal_ids = vote_casts.loc[vote_casts['voter'] != CRYPTEX_TEAM_MULTISIG_ADDRESS, 'proposalId'].unique()
+        if delegatees is not None:
+            vote_casts = vote_casts[vote_casts['voter'].isin(delegatees)]
+        vote_casts = vote_casts.loc[
+            vote_casts['proposalId'].isin(proposal_ids), ['id', 'voter', 'proposalId', 'blockNumber', 'blockTimestamp']
+        ].rename(
+            columns={'voter': 'delegatee', 'blockNumber': 'vote_block', 'blockTimestamp': 'vote_timestamp'}
+        ).sort_values(['vote_block', 'id']).drop_duplicates(['proposalId', 'delegatee']).drop(columns=['id'])
+
+        pairs = records[['delegator', 'delegatee']].drop_duplicates()
+        candidates = pairs.merge(vote_casts, on='delegatee').sort_values('vote_block')
+        if candidates.empty:
+            return []
+
+        by = ['delegator', 'delegatee']
+        zero_records = records.loc[
+            (records['balance'] == 0) & (records['blockNumber'] >= START_BLOCK), by + ['blockNumber']
+        ].rename(columns={'blockNumber': 'zero_block'})
+        candidates = pd.merge_asof(
+            candidates, zero_records, left_on='vote_block', right_on='zero_block', by=by, allow_exact_matches=False
+        )
+        candidates['after_block'] = candidates['zero_block'].fillna(START_BLOCK).astype('int64')
+
+        entries = records[by + ['blockNumber', 'blockTimestamp']].rename(
+            columns={'blockNumber': 'entry_block', 'blockTimestamp': 'entry_timestamp'}
+        )
+        candidates = pd.merge_asof(
+            candidates.sort_values('after_block'), entries, left_on='after_block', right_on='entry_block', by=by,
+            direction='forward', allow_exact_matches=False,
+        )
+        candidates = candidates[candidates['entry_block'] < candidates['vote_block']]
+
+        positive_records = records.loc[records['balance'] > 0, by + ['blockNumber', 'balance']].rename(
+            columns={'blockNumber': 'balance_block'}
+        )
+        candidates = pd.merge_asof(
+            candidates.sort_values('vote_block'), positive_records, left_on='vote_block', right_on='balance_block',
+            by=by, allow_exact_matches=False,
+        ).sort_values(['delegator', 'delegatee', 'proposalId'])
+
+        vote_stats = []
+        for row in candidates.itertuples(index=False):
+            start_date = max(START_DATETIME, convert_epoch_to_datetime(int(row.entry_timestamp)))
+            no_of_days_staked = no_of_days(start_date, convert_epoch_to_datetime(int(row.vote_timestamp)))
+            if no_of_days_staked:
+                vote_stats.append(dict(
+                    delegator=row.delegator,
+                    delegatee=row.delegatee,
+                    proposalId=int(row.proposalId),
+                    balance=row.balance if isinstance(row.balance, Decimal) else Decimal("0"),
+                    no_of_days=no_of_days_staked,
+                ))
+        return vote_stats
+
     def check_days_staked_and_create_record(self, session, proposal_id, delegator, delegatee, vote_cast):
         no_of_days_staked, balance = self.calculate_no_days_staked_before_vote(session, delegator, delegatee, vote_cast)
         if no_of_days_staked:
@@ -635,77 +865,244 @@ class VoteStatBuilder:
                 return 0, 0
 
 
+def build_vote_stat_partition(database_url, delegatees, vote_casts):
+    with worker_session(database_url) as session:
+        vote_stats = VoteStatBuilder(vote_casts).compute_vote_stats(session, delegatees)
+        if vote_stats:
+            session.execute(insert(VoteStat), vote_stats)
+        session.commit()
+    return len(vote_stats)
+
+
 TOTAL_REWARD = 50_000
-KEEPER_SPLIT = 0.2
+# rewards are computed and paid out in wei
+TOTAL_REWARD_WEI = TOTAL_REWARD * 10 ** 18
+KEEPER_SPLIT = Fraction(1, 5)
+# fractional wei are ranked in units of 1 / REMAINDER_SCALE wei when rounding
+REMAINDER_SCALE = 10 ** 18
 USER_SPLIT = 1 - KEEPER_SPLIT
 excel_file_path = 'distribution_data.xlsx'
+# vote_stat rows are read in this order, the order compute_vote_stats produces them in
+VOTE_STAT_ORDER = [VoteStat.delegator, VoteStat.delegatee, VoteStat.proposalId]
+# rows read and written at a time by the streaming export
+EXPORT_CHUNK_SIZE = 50_000
+# the vote_cast columns the vote stats and the distribution are computed from
+VOTE_CAST_COLUMNS = ['id', 'voter', 'proposalId', 'votes', 'blockNumber', 'blockTimestamp']
+
+
+def read_table(session, model, order_by=None):
+    # read through the session rather than pd.read_sql_table, so the column types convert the values
+    columns = model.__table__.c
+    statement = select(*columns).order_by(*(order_by or [model.id]))
+    return pd.DataFrame(session.execute(statement).all(), columns=columns.keys())
+
 
+def read_vote_casts(session):
+    return read_table(session, VoteCast)[VOTE_CAST_COLUMNS]
 
-def convert_from_wei(amount):
-    return from_wei(amount, 'ether')
+
+def format_distribution(df):
+    return df.assign(reward=wei_to_ether(df['reward']))
+
+
+def format_vote_stats(df):
+    df = df.rename(columns={'no_of_days': 'number of days staked', 'balance': 'delegated_amount'})
+    df['delegator'] = checksum_addresses(df['delegator'])
+    df['delegatee'] = checksum_addresses(df['delegatee'])
+    df['delegated_amount'] = wei_to_ether(df['delegated_amount'])
+    return df
+
+
+def format_delegation_records(df):
+    df = df.rename(columns={'balance': 'delegated_amount'})
+    df['delegator'] = checksum_addresses(df['delegator'])
+    df['delegatee'] = checksum_addresses(df['delegatee'])
+    df['delegated_amount'] = wei_to_ether(df['delegated_amount'])
+    return df
 
 
 class GenerateDistribution:
-    def __init__(self):
+    """
+    Rewards are computed exactly: every share of TOTAL_REWARD_WEI is kept as an
+    integer numerator/denominator pair and only rounded to whole wei once, in
+    apportion_rewards.
+    """
+
+    def __init__(self, vote_casts=None):
+        # vote_cast rows as a DataFrame, e.g. read from a snapshot, else read from the database
+        self.vote_casts = vote_casts
         self.balances = defaultdict(int)
+        # exact shares, one frame of address/numerator/denominator per fill_* call
+        self.shares = []
+        # exact sum of all shares
+        self.total_share = Fraction(0)
+        # wei of TOTAL_REWARD_WEI that no one is eligible for, e.g. a keeper vote without delegators
+        self.undistributed = 0
 
-    def generate(self):
+    def generate(self, streaming=False, export_formats=("xlsx",), chunk_size=EXPORT_CHUNK_SIZE):
         with Session() as session:
-            keeper_vote_cast_data = self.fetch_keeper_vote_cast_data(session)
+            vote_casts = self.vote_casts if self.vote_casts is not None else read_vote_casts(session)
+            keeper_vote_cast_data = self.fetch_keeper_vote_cast_data(vote_casts)
             self.fill_keeper_balances(keeper_vote_cast_data)
-            self.fill_user_balances(session, keeper_vote_cast_data)
+            self.fill_user_balances(session, vote_casts, keeper_vote_cast_data)
+            self.apportion_rewards()
             df1 = pd.DataFrame(list(sorted(self.balances.items(), key=lambda x: -x[1])), columns=['address', 'reward'])
-            df2 = pd.read_sql_table(
-                VoteStat.__tablename__, session.bind
-            ).drop(columns=['id']
-                   ).rename(columns={'no_of_days': 'number of days staked', 'balance': 'delegated_amount'})
-            df3 = pd.read_sql_table(DelegationRecord.__tablename__, session.bind).drop(
-                columns=['id', 'event_type']).rename(columns={'balance': 'delegated_amount'})
+            df1['address'] = checksum_addresses(df1['address'])
             df4 = pd.DataFrame(keeper_vote_cast_data, columns=['Keeper', 'No of Proposals voted on'])
+            if streaming:
+                self.export_streaming(session, df1, df4, export_formats, chunk_size)
+            else:
+                self.export(session, df1, df4)
 
-        df1['address'] = df1['address'].apply(to_checksum_address)
-        df2['delegator'] = df2['delegator'].apply(to_checksum_address)
-        df2['delegatee'] = df2['delegatee'].apply(to_checksum_address)
-        df2['delegated_amount'] = df2['delegated_amount'].apply(convert_from_wei)
-        df3['delegator'] = df3['delegator'].apply(to_checksum_address)
-        df3['delegatee'] = df3['delegatee'].apply(to_checksum_address)
-        df3['delegated_amount'] = df3['delegated_amount'].apply(convert_from_wei)
+        # as decimal strings, JSON numbers lose precision above 2**53 in most parsers
+        df1.assign(reward_wei=df1['reward'].astype(str)).drop(columns=['reward']).to_json(
+            'distribution.json', orient='records', lines=True
+        )
 
+    @staticmethod
+    def export(session, df1, df4):
+        df2 = format_vote_stats(read_table(session, VoteStat, VOTE_STAT_ORDER).drop(columns=['id']))
+        df3 = format_delegation_records(read_table(session, DelegationRecord).drop(columns=['id', 'event_type']))
         with pd.ExcelWriter(excel_file_path, engine='xlsxwriter') as writer:
-            df1.to_excel(writer, sheet_name='Distribution', index=False)
+            format_distribution(df1).to_excel(writer, sheet_name='Distribution', index=False)
             df2.to_excel(writer, sheet_name='Voting Stats', index=False)
             df3.to_excel(writer, sheet_name='Delegation Data', index=False)
             df4.to_excel(writer, sheet_name='Keeper Votes', index=False)
 
-        df1['reward'] = df1['reward'].apply(int)
-        df1.to_json('distribution.json', orient='records', lines=True)
+    @staticmethod
+    def export_streaming(session, df1, df4, export_formats, chunk_size):
+        # vote_stat and delegation_record are read and written chunk by chunk,
+        # so memory doesn't grow with the number of records
+        vote_stat_columns = [
+            VoteStat.delegator, VoteStat.delegatee, VoteStat.proposalId, VoteStat.balance, VoteStat.no_of_days
+        ]
+        delegation_record_columns = [
+            DelegationRecord.delegator,
+            DelegationRecord.delegatee,
+            DelegationRecord.balance,
+            DelegationRecord.blockNumber,
+            DelegationRecord.blockTimestamp,
+            DelegationRecord.transactionHash,
+        ]
+        vote_stats = (
+            format_vote_stats(pd.DataFrame(rows, columns=[column.key for column in vote_stat_columns]))
+            for rows in iter_query_chunks(
+                session, select(*vote_stat_columns).order_by(*VOTE_STAT_ORDER), chunk_size
+            )
+        )
+        delegation_records = (
+            format_delegation_records(pd.DataFrame(rows, columns=[column.key for column in delegation_record_columns]))
+            for rows in iter_query_chunks(
+                session, select(*delegation_record_columns).order_by(DelegationRecord.id), chunk_size
+            )
+        )
+        base_path, _ = os.path.splitext(excel_file_path)
+        with StreamingExport(base_path, export_formats) as export:
+            export.write_sheet('Distribution', list(df1.columns), [format_distribution(df1)])
+            export.write_sheet(
+                'Voting Stats',
+                ['delegator', 'delegatee', 'proposalId', 'delegated_amount', 'number of days staked'],
+                vote_stats,
+            )
+            export.write_sheet(
+                'Delegation Data',
+                ['delegator', 'delegatee', 'delegated_amount', 'blockNumber', 'blockTimestamp', 'transactionHash'],
+                delegation_records,
+            )
+            export.write_sheet('Keeper Votes', list(df4.columns), [df4])
 
-    def fill_user_balances(self, session, keeper_vote_cast_data):
+    def fill_user_balances(self, session, vote_casts, keeper_vote_cast_data):
         total_weight_for_distribution = sum(obj[1] for obj in keeper_vote_cast_data)
-        for keeper, no_proposals in keeper_vote_cast_data:
-            # keeper_delgators_reward = (no_proposals * USER_SPLIT * TOTAL_REWARD) / total_weight_for_distribution
-            # keeper_delegators_reward_per_proposal = keeper_delgators_reward / no_proposals
-            for proposal_id, in session.query(VoteCast.proposalId).filter(VoteCast.voter == keeper):
-                proposal_delegators = session.query(
-                    VoteStat.delegator, VoteStat.balance, VoteStat.no_of_days
-                ).filter(and_(VoteStat.delegatee == keeper, VoteStat.proposalId == proposal_id)).all()
-                proposal_keeper_total_weight = sum(obj[1] * obj[2] for obj in proposal_delegators)
-                for delegator, balance, no_of_days in proposal_delegators:
-                    # self.balances[delegator] += (
-                    #     int(balance) * no_of_days * keeper_delegators_reward_per_proposal
-                    # ) / int(proposal_keeper_total_weight)
-                    self.balances[delegator] += (
-                        int(balance) * no_of_days * no_proposals * USER_SPLIT * TOTAL_REWARD
-                    ) / (total_weight_for_distribution * no_proposals * int(proposal_keeper_total_weight))
+        keepers = pd.DataFrame(
+            [(keeper, rank, no_proposals) for rank, (keeper, no_proposals) in enumerate(keeper_vote_cast_data)],
+            columns=['delegatee', 'keeper_rank', 'no_proposals'],
+        )
+        # one row per (keeper vote, delegator vote stat)
+        proposal_delegators = read_table(session, VoteStat, VOTE_STAT_ORDER).merge(
+            vote_casts[['id', 'voter', 'proposalId']].rename(columns={'id': 'vote_cast_id', 'voter': 'delegatee'}),
+            on=['delegatee', 'proposalId'],
+        )[['vote_cast_id', 'delegator', 'delegatee', 'balance', 'no_of_days']]
+        proposal_delegators = proposal_delegators.merge(keepers, on='delegatee').sort_values(
+            ['keeper_rank', 'vote_cast_id', 'delegator']
+        )
+        if proposal_delegators.empty:
+            return
+        # Every keeper vote gets an equal pool of USER_SPLIT * TOTAL_REWARD_WEI / total_weight,
+        # split between the keeper's delegators by balance * no_of_days. Weights are python ints.
+        proposal_delegators['weight'] = pd.Series([
+            int(balance) * int(no_of_days)
+            for balance, no_of_days in zip(proposal_delegators['balance'], proposal_delegators['no_of_days'])
+        ], index=proposal_delegators.index, dtype=object)
+        proposal_delegators['proposal_keeper_total_weight'] = proposal_delegators.groupby(
+            ['keeper_rank', 'vote_cast_id'], sort=False
+        )['weight'].transform(sum)
+        proposal_delegators = proposal_delegators[proposal_delegators['proposal_keeper_total_weight'] > 0]
+        self.shares.append(pd.DataFrame({
+            'address': proposal_delegators['delegator'],
+            'numerator': proposal_delegators['weight'] * (TOTAL_REWARD_WEI * USER_SPLIT.numerator),
+            'denominator': proposal_delegators['proposal_keeper_total_weight'] * (
+                USER_SPLIT.denominator * total_weight_for_distribution
+            ),
+        }))
+        no_of_pools = proposal_delegators[['keeper_rank', 'vote_cast_id']].drop_duplicates().shape[0]
+        self.total_share += no_of_pools * USER_SPLIT * TOTAL_REWARD_WEI / total_weight_for_distribution
 
     def fill_keeper_balances(self, keeper_vote_cast_data):
-        total_keeper_reward = KEEPER_SPLIT * TOTAL_REWARD
         total_weight = sum(obj[1] for obj in keeper_vote_cast_data)
-        for voter, no_of_proposals in keeper_vote_cast_data:
-            self.balances[voter] += (no_of_proposals * total_keeper_reward) / total_weight
+        if not total_weight:
+            return
+        self.shares.append(pd.DataFrame({
+            'address': [voter for voter, _ in keeper_vote_cast_data],
+            'numerator': [
+                no_of_proposals * TOTAL_REWARD_WEI * KEEPER_SPLIT.numerator
+                for _, no_of_proposals in keeper_vote_cast_data
+            ],
+            'denominator': KEEPER_SPLIT.denominator * total_weight,
+        }, dtype=object))
+        self.total_share += KEEPER_SPLIT * TOTAL_REWARD_WEI
+
+    def apportion_rewards(self):
+        """
+        Largest remainder rounding per address: the shares of an address are
+        floored to whole wei and summed, then the wei lost to flooring are handed
+        out one each to the addresses with the largest fractional part (ties go
+        to the lower address), so the rewards add up exactly to the distributed
+        total. Fractional parts are ranked in units of 1 / REMAINDER_SCALE wei,
+        so two addresses whose fractions differ by less than that are
+        treated as tied. Anything left of TOTAL_REWARD_WEI is recorded in
+        self.undistributed.
+        """
+        if not self.shares:
+            self.undistributed = TOTAL_REWARD_WEI
+            return
+        shares = pd.concat(self.shares, ignore_index=True)
+        shares['reward'] = shares['numerator'] // shares['denominator']
+        shares['fraction'] = shares['numerator'] % shares['denominator'] * REMAINDER_SCALE // shares['denominator']
+        rewards = shares.groupby('address', sort=True)[['reward', 'fraction']].sum()
+        # whole wei made up of the fractions of several shares of one address
+        rewards['reward'] += rewards['fraction'] // REMAINDER_SCALE
+        fraction = (rewards['fraction'] % REMAINDER_SCALE).astype('int64').to_numpy()
+
+        distributed = math.floor(self.total_share)
+        leftover = distributed - sum(rewards['reward'])
+        if leftover:
+            # largest fraction first, lower address first among equal fractions
+            order = np.lexsort((rewards.index.to_numpy(dtype=str), -fraction))
+            rewards.iloc[order[:leftover], rewards.columns.get_loc('reward')] += 1
+
+        for address, reward in zip(rewards.index, rewards['reward']):
+            self.balances[address] = int(reward)
+        self.undistributed = TOTAL_REWARD_WEI - distributed
 
     @staticmethod
-    def fetch_keeper_vote_cast_data(session):
-        return session.query(
-            VoteCast.voter, func.count(VoteCast.voter)
-        ).filter(VoteCast.voter != CRYPTEX_TEAM_MULTISIG_ADDRESS, VoteCast.votes > 0).group_by(VoteCast.voter).order_by(func.count(VoteCast.voter).desc()).all()
+    def fetch_keeper_vote_cast_data(vote_casts):
+        """
+        Returns (keeper, number of votes) of every voter with voting power
+        other than the team multisig, most votes first, then by address.
+        """
+        keeper_votes = vote_casts[
+            (vote_casts['voter'] != CRYPTEX_TEAM_MULTISIG_ADDRESS) & (vote_casts['votes'] > 0)
+        ].groupby('voter').size().reset_index(name='votes').sort_values(
+            ['votes', 'voter'], ascending=[False, True]
+        )
+        return [(voter, int(votes)) for voter, votes in zip(keeper_votes['voter'], keeper_votes['votes'])]
@@ -1,2 +1,34 @@
+from decimal import Decimal, localcontext
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from eth_utils.address import to_checksum_address
+
+WEI_PER_ETHER = Decimal(10 ** 18)
+
+
 def identity(value):
     return value
+
+
+@lru_cache(maxsize=None)
+def checksum_address(address):
+    return to_checksum_address(address)
+
+
+def checksum_addresses(addresses):
+    # the same few thousand addresses repeat across every sheet, so each
+    # unique address is hashed once and the results are mapped back.
+    codes, uniques = pd.factorize(addresses)
+    checksummed = np.array([checksum_address(address) for address in uniques], dtype=object)
+    return pd.Series(checksummed[codes], index=getattr(addresses, "index", None), dtype=object)
+
+
+def wei_to_ether(amounts):
+    # same result as eth_utils' from_wei(amount, 'ether') for every amount,
+    # without entering a decimal context per value.
+    with localcontext() as ctx:
+        ctx.prec = 999
+        ether = [0 if amount == 0 else Decimal(amount) / WEI_PER_ETHER for amount in amounts]
+    return pd.Series(ether, index=getattr(amounts, "index", None), dtype=object)
@@ -0,0 +1,43 @@
+import os
+import threading
+
+# src.database connects at import time
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import pytest  # noqa: E402
+
+from src.benchmark import HistoryGenerator, load_history  # noqa: E402
+from src.database import Session, engine, use_database  # noqa: E402
+from src.replay import StandInIndexer, synthetic_fixtures  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A fresh database file, so that worker processes can open it too."""
+    database_engine = use_database(f"sqlite:///{tmp_path / 'stats.db'}")
+    yield database_engine
+    Session.configure(bind=engine)
+    database_engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def fixtures():
+    return synthetic_fixtures(2500, seed=5)
+
+
+@pytest.fixture
+def indexer(fixtures):
+    server = StandInIndexer(("127.0.0.1", 0), fixtures=fixtures)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def history(database):
+    """A consistent event history, e.g. for the distribution stages."""
+    with Session() as session:
+        load_history(session, HistoryGenerator(seed=1).generate())
+    return database
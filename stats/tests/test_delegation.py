@@ -0,0 +1,24 @@
+import pandas as pd
+
+from src.database import Session
+from src.models import DelegationRecord, VoteStat
+from src.stats import VOTE_STAT_ORDER, BuildAccountDelegation, VoteStatBuilder, read_table
+
+
+def build_tables(workers):
+    # small batches, so the transactions are classified by several workers
+    BuildAccountDelegation(flush_size=50).build(rebuild=True, workers=workers)
+    VoteStatBuilder().build(workers=workers)
+    with Session() as session:
+        return (
+            read_table(session, DelegationRecord).drop(columns=['id']),
+            read_table(session, VoteStat, VOTE_STAT_ORDER).drop(columns=['id']),
+        )
+
+
+def test_parallel_build_matches_serial_build(history):
+    delegation_records, vote_stats = build_tables(workers=1)
+    assert not delegation_records.empty and not vote_stats.empty
+    parallel_delegation_records, parallel_vote_stats = build_tables(workers=3)
+    pd.testing.assert_frame_equal(parallel_delegation_records, delegation_records)
+    pd.testing.assert_frame_equal(parallel_vote_stats, vote_stats)
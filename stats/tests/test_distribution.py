@@ -0,0 +1,72 @@
+import json
+from collections import defaultdict
+from fractions import Fraction
+
+import pandas as pd
+
+from src.database import Session
+from src.stats import (
+    TOTAL_REWARD_WEI,
+    BuildAccountDelegation,
+    GenerateDistribution,
+    VoteStatBuilder,
+    read_vote_casts,
+)
+
+
+def apportioned_distribution():
+    BuildAccountDelegation().build()
+    VoteStatBuilder().build()
+    distribution = GenerateDistribution()
+    with Session() as session:
+        vote_casts = read_vote_casts(session)
+        keeper_vote_cast_data = distribution.fetch_keeper_vote_cast_data(vote_casts)
+        distribution.fill_keeper_balances(keeper_vote_cast_data)
+        distribution.fill_user_balances(session, vote_casts, keeper_vote_cast_data)
+    distribution.apportion_rewards()
+    return distribution
+
+
+def test_rewards_sum_to_the_total_reward(history):
+    distribution = apportioned_distribution()
+    assert distribution.undistributed == 0
+    assert sum(distribution.balances.values()) == TOTAL_REWARD_WEI
+
+
+def test_rewards_are_within_one_wei_of_the_exact_share(history):
+    distribution = apportioned_distribution()
+    exact_rewards = defaultdict(Fraction)
+    for shares in distribution.shares:
+        for address, numerator, denominator in zip(shares['address'], shares['numerator'], shares['denominator']):
+            exact_rewards[address] += Fraction(int(numerator), int(denominator))
+    assert set(distribution.balances) == set(exact_rewards)
+    for address, exact_reward in exact_rewards.items():
+        assert abs(distribution.balances[address] - exact_reward) < 1
+
+
+def test_equal_remainders_go_to_the_lower_address():
+    # TOTAL_REWARD_WEI / 3 leaves 2 wei to hand out between three equal fractions
+    addresses = ["0x03", "0x01", "0x02"]
+    balances = []
+    for order in (addresses, addresses[::-1]):
+        distribution = GenerateDistribution()
+        distribution.shares.append(pd.DataFrame(
+            {'address': order, 'numerator': TOTAL_REWARD_WEI, 'denominator': 3}, dtype=object
+        ))
+        distribution.total_share = Fraction(TOTAL_REWARD_WEI)
+        distribution.apportion_rewards()
+        balances.append(dict(distribution.balances))
+    floor = TOTAL_REWARD_WEI // 3
+    assert balances[0] == balances[1] == {"0x01": floor + 1, "0x02": floor + 1, "0x03": floor}
+
+
+def test_distribution_json_keeps_wei_exact(history, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    BuildAccountDelegation().build()
+    VoteStatBuilder().build()
+    distribution = GenerateDistribution()
+    distribution.generate(streaming=True, export_formats=["csv"])
+    with open("distribution.json") as f:
+        records = [json.loads(line) for line in f]
+    assert all(isinstance(record["reward_wei"], str) for record in records)
+    assert sum(int(record["reward_wei"]) for record in records) == TOTAL_REWARD_WEI
@@ -0,0 +1,57 @@
+import json
+from decimal import Decimal
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from src.export import StreamingExport, sheet_file_path
+
+COLUMNS = ["delegator", "proposalId", "delegated_amount"]
+ROWS = [
+    ("0x" + f"{i:040x}", i % 7, Decimal(10 ** 24 + i) / Decimal(10 ** 18))
+    for i in range(25)
+]
+
+
+def export_sheet(base_path, export_format):
+    chunks = [pd.DataFrame(ROWS[i:i + 10], columns=COLUMNS) for i in range(0, len(ROWS), 10)]
+    with StreamingExport(base_path, [export_format]) as export:
+        export.write_sheet("Voting Stats", COLUMNS, chunks)
+
+
+def test_csv_round_trip(tmp_path):
+    export_sheet(tmp_path / "distribution", "csv")
+    df = pd.read_csv(sheet_file_path(tmp_path / "distribution", "Voting Stats", "csv"), dtype=str)
+    assert list(df.columns) == COLUMNS
+    assert [(row[0], int(row[1]), Decimal(row[2])) for row in df.itertuples(index=False)] == ROWS
+
+
+def test_jsonl_round_trip(tmp_path):
+    export_sheet(tmp_path / "distribution", "jsonl")
+    with open(sheet_file_path(tmp_path / "distribution", "Voting Stats", "jsonl")) as f:
+        records = [json.loads(line) for line in f]
+    assert [tuple(record) for record in records] == [tuple(COLUMNS)] * len(ROWS)
+    assert [
+        (record["delegator"], record["proposalId"], Decimal(record["delegated_amount"])) for record in records
+    ] == ROWS
+
+
+def test_parquet_round_trip(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    export_sheet(tmp_path / "distribution", "parquet")
+    path = sheet_file_path(tmp_path / "distribution", "Voting Stats", "parquet")
+    table = pq.read_table(path)
+    assert table.column_names == COLUMNS
+    # one row group per chunk
+    assert pq.ParquetFile(path).num_row_groups == 3
+    assert [tuple(row.values()) for row in table.to_pylist()] == ROWS
+
+
+def test_xlsx_round_trip(tmp_path):
+    export_sheet(tmp_path / "distribution", "xlsx")
+    worksheet = openpyxl.load_workbook(tmp_path / "distribution.xlsx")["Voting Stats"]
+    rows = list(worksheet.iter_rows(values_only=True))
+    assert rows[0] == tuple(COLUMNS)
+    # excel stores numbers as doubles
+    assert rows[1:] == [(delegator, proposal_id, float(amount)) for delegator, proposal_id, amount in ROWS]
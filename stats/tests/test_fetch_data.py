@@ -0,0 +1,175 @@
+import copy
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+from src import fetch_data
+from src.database import Session, use_database
+from src.fetch_data import STREAMS, fetch_all_data, fetch_and_write_stream, get_last_cursor, list_sync_state
+from src.models import FetchShard
+from src.graphql import GraphClient, RateLimiter
+from src.replay import FixtureIndex
+from src.stats import read_table
+
+
+def stored_ids(table_key):
+    model = STREAMS[table_key]["model"]
+    with Session() as session:
+        return {entity_id for entity_id, in session.query(model.id)}
+
+
+def link_transfers_to_delegations(fixtures):
+    """Moves some transfers into delegation transactions, so the targeted batches find them."""
+    fixtures = copy.deepcopy(fixtures)
+    delegation_transactions = fixtures["delegateVotesChangeds"][::10]
+    for transfer, votes_changed in zip(fixtures["transfers"][::5], delegation_transactions):
+        transfer["blockNumber"] = votes_changed["blockNumber"]
+        transfer["transactionHash"] = votes_changed["transactionHash"]
+    return fixtures
+
+
+def expected_ids(fixtures, table_key, transfers):
+    if table_key == "transfers" and transfers == "targeted":
+        delegation_hashes = {votes_changed["transactionHash"] for votes_changed in fixtures["delegateVotesChangeds"]}
+        return {
+            transfer["id"] for transfer in fixtures["transfers"] if transfer["transactionHash"] in delegation_hashes
+        }
+    return {entity["id"] for entity in fixtures[table_key]}
+
+
+def read_stream_tables():
+    with Session() as session:
+        return {table_key: read_table(session, stream["model"]) for table_key, stream in STREAMS.items()}
+
+
+def test_interrupted_row_by_row_page_is_written_again(database, indexer, fixtures, monkeypatch):
+    advance_sync_state = fetch_data.advance_sync_state
+    checkpoints = []
+
+    def fail_on_second_page(session, table_key, results):
+        checkpoints.append(results)
+        if len(checkpoints) == 2:
+            raise RuntimeError("interrupted")
+        advance_sync_state(session, table_key, results)
+
+    monkeypatch.setattr(fetch_data, "advance_sync_state", fail_on_second_page)
+    with pytest.raises(RuntimeError):
+        fetch_and_write_stream("stakeds", url=indexer.url, bulk=False, composite_cursor=True)
+    # the rows of the interrupted page were rolled back with its cursor
+    assert stored_ids("stakeds") == {entity["id"] for entity in checkpoints[0]}
+
+    monkeypatch.setattr(fetch_data, "advance_sync_state", advance_sync_state)
+    fetch_and_write_stream("stakeds", url=indexer.url, bulk=False, composite_cursor=True)
+    assert stored_ids("stakeds") == {entity["id"] for entity in fixtures["stakeds"]}
+    last_entity = max(fixtures["stakeds"], key=lambda entity: (int(entity["blockNumber"]), entity["id"]))
+    assert get_last_cursor("stakeds") == (int(last_entity["blockNumber"]), last_entity["id"])
+
+
+def test_composite_cursor_requests_one_page_at_a_time(database, indexer, fixtures, monkeypatch):
+    fixtures = copy.deepcopy(fixtures)
+    # more entities in one block than fit in a page
+    for staked in fixtures["stakeds"][:1500]:
+        staked["blockNumber"] = fixtures["stakeds"][0]["blockNumber"]
+    indexer.index = FixtureIndex(fixtures)
+    queries = []
+    request = GraphClient.request
+
+    def record_request(client, query):
+        queries.append(query)
+        return request(client, query)
+
+    monkeypatch.setattr(GraphClient, "request", record_request)
+    fetch_and_write_stream("stakeds", url=indexer.url, composite_cursor=True)
+    assert stored_ids("stakeds") == {entity["id"] for entity in fixtures["stakeds"]}
+    # 1000 + 1000 + 500 entities
+    assert len(queries) == 3
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_full_transfers_after_targeted_transfers(database, indexer, fixtures, bulk):
+    fixtures = link_transfers_to_delegations(fixtures)
+    indexer.index = FixtureIndex(fixtures)
+
+    fetch_all_data(url=indexer.url, transfers="targeted", bulk=bulk, concurrency=1)
+    assert stored_ids("transfers") == expected_ids(fixtures, "transfers", "targeted")
+    fetch_all_data(url=indexer.url, transfers="full", bulk=bulk, concurrency=1)
+    assert stored_ids("transfers") == {transfer["id"] for transfer in fixtures["transfers"]}
+
+
+@pytest.mark.parametrize("transfers", ["targeted", "full"])
+def test_every_stream_resumes_from_its_cursor(database, indexer, fixtures, transfers):
+    fixtures = link_transfers_to_delegations(fixtures)
+    # the indexer first serves the blocks up to the middle of the history, then all of them
+    middle_block = sorted(int(entity["blockNumber"]) for entity in fixtures["delegateVotesChangeds"])[1250]
+    first_half = {
+        table_key: [entity for entity in entities if int(entity["blockNumber"]) <= middle_block]
+        for table_key, entities in fixtures.items()
+    }
+    indexer.index = FixtureIndex(first_half)
+    fetch_all_data(url=indexer.url, transfers=transfers, concurrency=1)
+    for table_key in STREAMS:
+        assert stored_ids(table_key) == expected_ids(first_half, table_key, transfers)
+
+    indexer.index = FixtureIndex(fixtures)
+    rows_fetched = Counter()
+    fetch_all_data(
+        url=indexer.url,
+        transfers=transfers,
+        concurrency=1,
+        progress=lambda table_key, page_rows: rows_fetched.update({table_key: page_rows}),
+    )
+    for table_key in STREAMS:
+        assert stored_ids(table_key) == expected_ids(fixtures, table_key, transfers)
+        if table_key == "transfers" and transfers == "targeted":
+            continue
+        # only the entities after the cursor were fetched again
+        assert rows_fetched[table_key] == len(fixtures[table_key]) - len(first_half[table_key])
+        last_entity = max(fixtures[table_key], key=lambda entity: (int(entity["blockNumber"]), entity["id"]))
+        assert get_last_cursor(table_key) == (int(last_entity["blockNumber"]), last_entity["id"])
+
+
+@pytest.mark.parametrize("options", [dict(), dict(transfers="full"), dict(batch_queries=True)])
+def test_row_by_row_writes_the_same_rows_as_bulk(database, indexer, tmp_path, options):
+    fetch_all_data(url=indexer.url, bulk=True, concurrency=1, **options)
+    bulk_tables = read_stream_tables()
+    bulk_sync_state = [(state.stream, state.blockNumber, state.entity_id) for state in list_sync_state()]
+
+    row_by_row_engine = use_database(f"sqlite:///{tmp_path / 'row_by_row.db'}")
+    try:
+        fetch_all_data(url=indexer.url, bulk=False, concurrency=1, **options)
+        row_by_row_tables = read_stream_tables()
+        row_by_row_sync_state = [(state.stream, state.blockNumber, state.entity_id) for state in list_sync_state()]
+    finally:
+        row_by_row_engine.dispose()
+    assert any(not table.empty for table in bulk_tables.values())
+    for table_key, table in bulk_tables.items():
+        pd.testing.assert_frame_equal(row_by_row_tables[table_key], table)
+    assert row_by_row_sync_state == bulk_sync_state
+
+
+@pytest.mark.parametrize("options", [dict(), dict(shards=3, transfers="full"), dict(batch_queries=True)])
+def test_every_request_of_a_fetch_shares_one_rate_limiter(database, indexer, monkeypatch, options):
+    limiters = set()
+    wait = RateLimiter.wait
+
+    def record_wait(rate_limiter):
+        limiters.add(id(rate_limiter))
+        wait(rate_limiter)
+
+    monkeypatch.setattr(RateLimiter, "wait", record_wait)
+    fetch_all_data(url=indexer.url, **options)
+    assert len(limiters) == 1
+
+
+@pytest.mark.parametrize("transfers, sharded_stream", [("targeted", "delegateVotesChangeds"), ("full", "transfers")])
+def test_shards_split_a_stream_that_is_fetched(database, indexer, fixtures, transfers, sharded_stream):
+    fetch_all_data(url=indexer.url, shards=3, transfers=transfers, concurrency=1)
+    with Session() as session:
+        assert {table_key for table_key, in session.query(FetchShard.table_key).distinct()} == {sharded_stream}
+    assert stored_ids(sharded_stream) == {entity["id"] for entity in fixtures[sharded_stream]}
+
+
+def test_targeted_transfers_are_not_sharded(database, indexer):
+    with pytest.raises(Exception, match="--transfers full"):
+        fetch_all_data(url=indexer.url, shards=3, sharded_streams=["transfers"])